@@ -0,0 +1,343 @@
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+from feature_store import FeatureStore
+from get_features import get_top_k
+
+META_FILE = 'meta.json'
+INDEX_FILE = 'index.txt'
+CENTROIDS_FILE = 'centroids.npy'
+VECTORS_FILE = 'vectors.npy'
+NORMS_FILE = 'norms.npy'
+ROWS_FILE = 'rows.npy'
+OFFSETS_FILE = 'offsets.npy'
+
+
+def _normalize_rows(X):
+    norms = np.sqrt((X * X).sum(axis=1))[:, np.newaxis]
+    return X / np.maximum(norms, 1e-12)
+
+
+def _read_float_rows(store, start, stop, normalize):
+    X = np.asarray(store.read_rows(start, stop), dtype=np.float32)
+    return _normalize_rows(X) if normalize else X
+
+
+def _partial_distances(queries, vectors, vector_norms):
+    """Squared L2 distances between every query and every vector, minus the
+    squared norm of the query, which does not change the ranking
+    """
+    return vector_norms[np.newaxis, :] - 2 * queries.dot(vectors.T)
+
+
+def _nearest_centroids(X, centroids, chunk_size=10000):
+    centroid_norms = (centroids * centroids).sum(axis=1)
+    assignments = np.empty(len(X), dtype=np.int32)
+    for start in range(0, len(X), chunk_size):
+        distances = _partial_distances(X[start:start + chunk_size], centroids, centroid_norms)
+        assignments[start:start + chunk_size] = distances.argmin(axis=1)
+    return assignments
+
+
+def train_centroids(store, num_lists, train_size=50000, num_iters=10, normalize=False, seed=0,
+                    chunk_size=10000):
+    """Run k-means on a random sample of the rows of a store
+
+      Parameters:
+        store : FeatureStore
+        num_lists : number of centroids
+        train_size : number of rows sampled for training
+        num_iters : number of Lloyd iterations
+        normalize : cluster the rows scaled to unit length
+        seed : seed of the sampling and of the initial centroids
+        chunk_size : number of rows read at a time
+
+      Returns:
+        num_lists x D float32 array of centroids
+
+    """
+    rng = np.random.RandomState(seed)
+    num_rows = len(store)
+    if num_rows < num_lists:
+        raise ValueError("Need at least %d rows to train %d lists, the store has %d" %
+                         (num_lists, num_lists, num_rows))
+    sample_rows = np.sort(rng.choice(num_rows, min(train_size, num_rows), replace=False))
+    sample = np.empty((len(sample_rows), store.num_features), dtype=np.float32)
+    # read the store sequentially and keep the sampled rows of every chunk
+    for start in range(0, num_rows, chunk_size):
+        first, last = np.searchsorted(sample_rows, [start, start + chunk_size])
+        if last > first:
+            chunk = _read_float_rows(store, start, start + chunk_size, normalize)
+            sample[first:last] = chunk[sample_rows[first:last] - start]
+    centroids = sample[rng.choice(len(sample), num_lists, replace=False)]
+    for iteration in range(num_iters):
+        assignments = _nearest_centroids(sample, centroids, chunk_size)
+        order = np.argsort(assignments, kind='mergesort')
+        counts = np.bincount(assignments, minlength=num_lists)
+        filled = np.nonzero(counts)[0]
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))[filled]
+        centroids = centroids.copy()
+        centroids[filled] = np.add.reduceat(sample[order], starts, axis=0) / counts[filled][:, np.newaxis]
+        empty = np.nonzero(counts == 0)[0]
+        if len(empty):
+            # restart empty lists from random sample rows
+            centroids[empty] = sample[rng.choice(len(sample), len(empty), replace=False)]
+        if normalize:
+            centroids = _normalize_rows(centroids)
+    return centroids.astype(np.float32)
+
+
+def build_ivf_index(store_path, index_path, num_lists=1024, train_size=50000, num_iters=10, normalize=False,
+                    dtype=np.float32, seed=0, chunk_size=10000):
+    """Build an inverted file index over the rows of a feature store
+
+      Every row is assigned to its nearest k-means centroid and the rows are
+      written grouped by centroid, so the rows of one inverted list are
+      contiguous on disk and a query only reads the lists it probes. The
+      index is a directory holding:
+
+      meta.json: number of lists and features, dtype and normalize flag
+      centroids.npy: num_lists x D centroids
+      vectors.npy: N x D rows grouped by list
+      norms.npy: squared norms of the rows of vectors.npy
+      rows.npy: row of the feature store of every row of vectors.npy
+      offsets.npy: num_lists + 1 offsets of the lists in vectors.npy
+      index.txt: "key label" of every row of the feature store, in store order
+
+      The index is built in a temporary directory and renamed into place, so
+      a crash never leaves a partial index behind.
+
+      Parameters:
+        store_path : path of the FeatureStore, e.g. of fc7 features
+        index_path : directory of the index; it must not exist yet
+        num_lists : number of inverted lists; around sqrt(N) to 4 sqrt(N)
+        train_size, num_iters, seed : see train_centroids
+        normalize : index the rows scaled to unit length, so L2 ranking is
+          cosine similarity ranking; queries are normalized the same way
+        dtype : dtype of vectors.npy, e.g. np.float16 to halve its size
+        chunk_size : number of rows read at a time
+
+      Returns:
+        the IVFIndex, memory-mapped
+
+    """
+    if os.path.exists(index_path):
+        raise IOError("Index already exists: " + index_path)
+    store = FeatureStore(store_path, mode='r')
+    tmp_path = index_path + '.%d.tmp' % os.getpid()
+    os.makedirs(tmp_path)
+    try:
+        centroids = train_centroids(store, num_lists, train_size, num_iters, normalize, seed, chunk_size)
+        num_rows = len(store)
+        assignments = np.empty(num_rows, dtype=np.int32)
+        for start in range(0, num_rows, chunk_size):
+            X = _read_float_rows(store, start, start + chunk_size, normalize)
+            assignments[start:start + len(X)] = _nearest_centroids(X, centroids, chunk_size)
+        rows = np.argsort(assignments, kind='mergesort')
+        positions = np.empty(num_rows, dtype=np.int64)
+        positions[rows] = np.arange(num_rows)
+        offsets = np.concatenate(([0], np.cumsum(np.bincount(assignments, minlength=num_lists))))
+        vectors = np.lib.format.open_memmap(os.path.join(tmp_path, VECTORS_FILE), mode='w+', dtype=dtype,
+                                            shape=(num_rows, store.num_features))
+        norms = np.empty(num_rows, dtype=np.float32)
+        for start in range(0, num_rows, chunk_size):
+            X = _read_float_rows(store, start, start + chunk_size, normalize).astype(dtype)
+            vectors[positions[start:start + len(X)]] = X
+            X = X.astype(np.float32)
+            norms[positions[start:start + len(X)]] = (X * X).sum(axis=1)
+        vectors.flush()
+        del vectors
+        np.save(os.path.join(tmp_path, CENTROIDS_FILE), centroids)
+        np.save(os.path.join(tmp_path, NORMS_FILE), norms)
+        np.save(os.path.join(tmp_path, ROWS_FILE), rows.astype(np.int64))
+        np.save(os.path.join(tmp_path, OFFSETS_FILE), offsets.astype(np.int64))
+        with open(os.path.join(tmp_path, INDEX_FILE), 'w') as f:
+            f.write(''.join('%s %s\n' % (key, label) for key, label in zip(store.keys, store.labels)))
+        with open(os.path.join(tmp_path, META_FILE), 'w') as f:
+            json.dump({'num_lists': num_lists, 'num_features': store.num_features,
+                       'dtype': np.dtype(dtype).name, 'normalize': normalize}, f)
+        os.rename(tmp_path, index_path)
+    except:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+    finally:
+        store.close()
+    return IVFIndex(index_path)
+
+
+class IVFIndex(object):
+    """
+    Inverted file index for approximate nearest-neighbour search, as written
+    by build_ivf_index.
+
+    The rows are memory-mapped, so loading an index is fast and only the
+    lists a query probes are read from disk. A query is compared to the
+    centroids and then to every row of its nprobe nearest lists; more probes
+    give a higher recall for a slower search.
+    """
+
+    def __init__(self, path):
+        """
+        Inputs:
+        - path: Directory of the index.
+        """
+        self.path = path
+        with open(os.path.join(path, META_FILE)) as f:
+            self.meta = json.load(f)
+        self.num_lists = self.meta['num_lists']
+        self.num_features = self.meta['num_features']
+        self.normalize = self.meta['normalize']
+        self.centroids = np.load(os.path.join(path, CENTROIDS_FILE))
+        self.vectors = np.load(os.path.join(path, VECTORS_FILE), mmap_mode='r')
+        self.norms = np.load(os.path.join(path, NORMS_FILE), mmap_mode='r')
+        self.rows = np.load(os.path.join(path, ROWS_FILE), mmap_mode='r')
+        self.offsets = np.load(os.path.join(path, OFFSETS_FILE))
+        self.keys = []
+        self.labels = []
+        with open(os.path.join(path, INDEX_FILE)) as f:
+            for line in f:
+                key, label = line.rstrip('\n').rsplit(' ', 1)
+                self.keys.append(key)
+                self.labels.append(label)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def search(self, queries, k=10, nprobe=8):
+        """
+        Find approximate nearest neighbours of a batch of queries.
+
+        The queries are grouped by the lists they probe, so every probed list
+        is read once per batch and compared to all its queries in a single
+        matrix product.
+
+        Inputs:
+        - queries: Array of shape (M, D), or a single vector of length D.
+        - k: Number of neighbours per query.
+        - nprobe: Number of inverted lists searched per query.
+
+        Returns a tuple of:
+        - rows: Array of shape (M, k) holding the feature store rows of the
+          neighbours, nearest first; -1 where fewer than k rows were probed.
+        - distances: Array of shape (M, k) holding the squared L2 distances.
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        if self.normalize:
+            queries = _normalize_rows(queries)
+        num_queries = len(queries)
+        nprobe = min(nprobe, self.num_lists)
+        centroid_norms = (self.centroids * self.centroids).sum(axis=1)
+        probes, _ = get_top_k(-_partial_distances(queries, self.centroids, centroid_norms), nprobe)
+        candidate_distances = np.empty((num_queries, nprobe * k), dtype=np.float32)
+        candidate_distances.fill(np.inf)
+        candidate_positions = np.zeros((num_queries, nprobe * k), dtype=np.int64)
+        candidate_positions.fill(-1)
+        for list_id in np.unique(probes):
+            start, stop = self.offsets[list_id], self.offsets[list_id + 1]
+            if stop == start:
+                continue
+            query_ids, ranks = np.nonzero(probes == list_id)
+            distances = _partial_distances(queries[query_ids], np.asarray(self.vectors[start:stop], np.float32),
+                                           np.asarray(self.norms[start:stop]))
+            if stop - start > k:
+                nearest = np.argpartition(distances, k - 1, axis=1)[:, :k]
+                distances = distances[np.arange(len(query_ids))[:, np.newaxis], nearest]
+            else:
+                nearest = np.tile(np.arange(stop - start), (len(query_ids), 1))
+            columns = ranks[:, np.newaxis] * k + np.arange(nearest.shape[1])
+            candidate_distances[query_ids[:, np.newaxis], columns] = distances
+            candidate_positions[query_ids[:, np.newaxis], columns] = start + nearest
+        best, neg_distances = get_top_k(-candidate_distances, k)
+        positions = candidate_positions[np.arange(num_queries)[:, np.newaxis], best]
+        rows = np.where(positions >= 0, self.rows[np.maximum(positions, 0)], -1)
+        distances = -neg_distances + (queries * queries).sum(axis=1)[:, np.newaxis]
+        return rows, np.maximum(distances, 0)
+
+    def keys_of(self, rows):
+        """
+        Map rows returned by search to their keys, dropping -1 rows.
+        """
+        return [[self.keys[row] for row in query_rows if row >= 0] for query_rows in np.atleast_2d(rows)]
+
+
+def exact_search(store, queries, k=10, normalize=False, chunk_size=10000):
+    """Find the exact nearest neighbours of a batch of queries by scanning a store
+
+      Parameters:
+        store : FeatureStore
+        queries : M x D array
+        k : number of neighbours per query
+        normalize : compare rows and queries scaled to unit length
+        chunk_size : number of rows read at a time
+
+      Returns:
+        (rows, distances), both M x k, nearest first, as IVFIndex.search
+
+    """
+    queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+    if normalize:
+        queries = _normalize_rows(queries)
+    num_queries = len(queries)
+    rows = np.zeros((num_queries, 0), dtype=np.int64)
+    distances = np.zeros((num_queries, 0), dtype=np.float32)
+    for start in range(0, len(store), chunk_size):
+        X = _read_float_rows(store, start, start + chunk_size, normalize)
+        chunk_distances = _partial_distances(queries, X, (X * X).sum(axis=1))
+        distances = np.hstack((distances, chunk_distances))
+        rows = np.hstack((rows, np.tile(np.arange(start, start + len(X)), (num_queries, 1))))
+        best, neg_distances = get_top_k(-distances, k)
+        rows = rows[np.arange(num_queries)[:, np.newaxis], best]
+        distances = -neg_distances
+    return rows, np.maximum(distances + (queries * queries).sum(axis=1)[:, np.newaxis], 0)
+
+
+def recall_at_k(approximate_rows, exact_rows):
+    """Mean fraction of the exact k nearest neighbours found by an approximate search
+    """
+    k = exact_rows.shape[1]
+    found = [len(np.intersect1d(approximate, exact)) for approximate, exact in zip(approximate_rows, exact_rows)]
+    return np.mean(found) / float(k)
+
+
+def evaluate_index(index, store, queries, k=10, nprobes=(1, 2, 4, 8, 16, 32), chunk_size=10000):
+    """Report recall@k and search time of an index against exact search
+
+      Parameters:
+        index : IVFIndex built from store
+        store : FeatureStore
+        queries : M x D array of queries
+        k : number of neighbours per query
+        nprobes : numbers of probed lists to try
+
+      Returns:
+        list of dicts with 'nprobe', 'recall' and 'ms_per_query', the
+        exact search first with nprobe None
+
+    """
+    start = time.time()
+    exact_rows, _ = exact_search(store, queries, k, index.normalize, chunk_size)
+    exact_seconds = time.time() - start
+    report = [{'nprobe': None, 'recall': 1.0, 'ms_per_query': 1000 * exact_seconds / len(queries)}]
+    for nprobe in nprobes:
+        start = time.time()
+        rows, _ = index.search(queries, k, nprobe)
+        seconds = time.time() - start
+        report.append({'nprobe': nprobe, 'recall': recall_at_k(rows, exact_rows),
+                       'ms_per_query': 1000 * seconds / len(queries)})
+    return report
+
+
+if __name__ == '__main__':
+    store_path = '/mnt/data/f7_features_train'
+    index_path = '/mnt/data/f7_ivf_train'
+    if not os.path.isdir(index_path):
+        build_ivf_index(store_path, index_path, num_lists=1024, normalize=True)
+    index = IVFIndex(index_path)
+    store = FeatureStore(store_path, mode='r')
+    queries = np.asarray(store.read_rows(0, 200), dtype=np.float32)
+    for line in evaluate_index(index, store, queries):
+        print "nprobe %-5s recall@10 %.3f  %.2f ms/query" % (line['nprobe'], line['recall'], line['ms_per_query'])
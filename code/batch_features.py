@@ -0,0 +1,176 @@
+import numpy as np
+
+
+def iter_batches(items, batch_size):
+    """Yield consecutive lists of at most batch_size items
+
+      Parameters:
+        items : any iterable
+        batch_size : maximum number of items per batch
+
+      Returns:
+        generator of lists; only the last one may be shorter than batch_size
+
+    """
+    if batch_size < 1:
+        raise ValueError("batch_size must be positive: " + str(batch_size))
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def set_input_batch(net, images, input_blob='data'):
+    """Copy a batch of preprocessed images into the input blob of the net
+
+      The blob is only reshaped when the number of images changes, so a run of
+      full batches reuses the same buffers and only the last partial batch
+      pays for a reshape.
+
+      Parameters:
+        net : caffe.Net or any object with the same blobs interface
+        images : sequence or N x C x H x W array of preprocessed images
+        input_blob : name of the input blob
+
+      Returns:
+        num_images : number of rows filled in the input blob
+
+    """
+    data_blob = net.blobs[input_blob]
+    num_images = len(images)
+    if data_blob.data.shape[0] != num_images:
+        data_blob.reshape(num_images, *data_blob.data.shape[1:])
+    if isinstance(images, np.ndarray):
+        data_blob.data[...] = images
+    else:
+        for i in range(num_images):
+            data_blob.data[i, ...] = images[i]
+    return num_images
+
+
+def validate_layers(net, layers):
+    """Raise TypeError unless every layer name is a blob of the net
+    """
+    for layer in layers:
+        if layer not in net.blobs:
+            raise TypeError("Invalid layer name: " + layer)
+
+
+def get_num_features(net, layer):
+    """Return the number of values a layer produces per image, e.g. 9216 for a 256 x 6 x 6 pool5
+    """
+    return int(np.prod(net.blobs[layer].data.shape[1:]))
+
+
+def forward_batch_layers(net, images, layers, input_blob='data'):
+    """Run a single forward pass and return the activations of several layers
+
+      Parameters:
+        net : caffe.Net or any object with the same blobs interface
+        images : sequence or N x C x H x W array of preprocessed images
+        layers : list of blob names
+        input_blob : name of the input blob
+
+      Returns:
+        list with one num_images x num_features view per layer, in the order
+        of layers. The views are overwritten by the next forward pass.
+
+    """
+    num_images = set_input_batch(net, images, input_blob)
+    net.forward()
+    return [net.blobs[layer].data[:num_images].reshape(num_images, -1) for layer in layers]
+
+
+def forward_batch(net, images, layer, input_blob='data'):
+    """Run a single forward pass over a batch of preprocessed images
+
+      Parameters:
+        net : caffe.Net or any object with the same blobs interface
+        images : sequence or N x C x H x W array of preprocessed images
+        layer : name of the blob whose activations are returned
+        input_blob : name of the input blob
+
+      Returns:
+        features : num_images x num_features view on the layer blob. It is
+          overwritten by the next forward pass, so copy it out before then.
+
+    """
+    return forward_batch_layers(net, images, [layer], input_blob)[0]
+
+
+def preprocess_batch(batch, preprocess_item):
+    """Preprocess a list of items, dropping those for which preprocess_item returns None
+
+      Returns:
+        (kept_items, images) where images is a list of C x H x W arrays
+
+    """
+    kept_items = []
+    images = []
+    for item in batch:
+        image = preprocess_item(item)
+        if image is None:
+            continue
+        kept_items.append(item)
+        images.append(image)
+    return kept_items, images
+
+
+def preprocess_batches(items, preprocess_item, batch_size):
+    """Serially preprocess items into batches of at most batch_size images
+
+      Returns:
+        generator of (kept_items, images) tuples, skipping empty batches
+
+    """
+    for batch in iter_batches(items, batch_size):
+        kept_items, images = preprocess_batch(batch, preprocess_item)
+        if kept_items:
+            yield kept_items, images
+
+
+def forward_batches(net, batches, layers, input_blob='data'):
+    """Run one forward pass for every (items, images) batch
+
+      Parameters:
+        net : caffe.Net or any object with the same blobs interface
+        batches : iterable of (items, images) tuples, as produced by
+          preprocess_batches or PreprocessPipeline.batches
+        layers : list of blob names
+        input_blob : name of the input blob
+
+      Returns:
+        generator of (items, features) tuples where features is the list of
+        views returned by forward_batch_layers
+
+    """
+    for batch_items, images in batches:
+        yield batch_items, forward_batch_layers(net, images, layers, input_blob)
+
+
+def extract_batched(net, items, preprocess_item, layer, batch_size, input_blob='data'):
+    """Preprocess items in batches and run one forward pass per batch
+
+      Items for which preprocess_item returns None (for example missing files)
+      are dropped from the batch they belong to.
+
+      Parameters:
+        net : caffe.Net or any object with the same blobs interface
+        items : iterable of items, e.g. image file names
+        preprocess_item : callable mapping an item to a C x H x W image or None
+        layer : name of the blob whose activations are returned
+        batch_size : number of items per forward pass
+        input_blob : name of the input blob
+
+      Returns:
+        generator of (batch_items, features) tuples where features is the
+        view returned by forward_batch for the kept items
+
+    """
+    batches = preprocess_batches(items, preprocess_item, batch_size)
+    for batch_items, features in forward_batches(net, batches, [layer], input_blob):
+        yield batch_items, features[0]
@@ -0,0 +1,504 @@
+"""
+Micro benchmarks for the feature extraction and training code
+They run on a CPU stand-in for the Caffe net, so neither Caffe nor a GPU is
+needed.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib2
+
+import numpy as np
+
+from ann_index import build_ivf_index, evaluate_index
+from batch_features import extract_batched, forward_batches, preprocess_batches
+from color_histogram import color_histogram_hsv, color_histograms_hsv
+from concatenate_features import LINE_OVERHEAD_BYTES, MAX_OPEN_RUNS, iter_sorted_lines, merge_join_files
+from feature_store import FeatureStore
+from get_features import get_top_arguments, get_top_k
+from hog_features import hog_feature, hog_features_batch
+from inference_server import InferenceServer
+from preprocess_pipeline import PreprocessPipeline
+from sharded_extraction import extract_sharded
+from tta import average_crops, forward_tta, oversample
+from standin_net import StandInNet, StandInTransformer, random_image
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'utils'))
+from minibatch_loader import MinibatchLoader
+from neural_net import TwoLayerNet, softmax_loss
+
+
+def time_call(function, *args, **kwargs):
+    """Return (seconds, result) of a single call
+    """
+
+    start = time.time()
+    result = function(*args, **kwargs)
+    return time.time() - start, result
+
+
+def benchmark_batched_forward(num_images=512, batch_sizes=(1, 10, 50, 100), forward_overhead=0.002):
+    """Compare one forward per image with one forward per batch
+    """
+
+    rng = np.random.RandomState(0)
+    images = [random_image(rng) for _ in range(num_images)]
+    transformer = StandInTransformer()
+    preprocess_item = lambda index: transformer.preprocess('data', images[index])
+    layer = 'fc7-food'
+    reference = None
+    for batch_size in batch_sizes:
+        net = StandInNet(forward_overhead=forward_overhead)
+        X = np.zeros((num_images, net.blobs[layer].data.shape[1]), dtype=np.float32)
+
+        def run():
+            count = 0
+            for batch_items, features in extract_batched(net, range(num_images), preprocess_item, layer, batch_size):
+                X[count:count + len(batch_items)] = features
+                count += len(batch_items)
+            return count
+
+        seconds, count = time_call(run)
+        if reference is None:
+            reference = X.copy()
+        assert count == num_images
+        assert np.allclose(reference, X, rtol=1e-4, atol=1e-2)
+        print 'batch_size %4d: %8.3f s, %8.1f images/s' % (batch_size, seconds, num_images / seconds)
+
+
+class SyntheticDecoder(object):
+    """Preprocess callable that stands in for JPEG decoding plus Transformer.preprocess
+    """
+
+    def __init__(self, decode_seconds=0.004):
+        self.decode_seconds = decode_seconds
+        self.transformer = StandInTransformer()
+
+    def __call__(self, index):
+        start = time.time()
+        image = random_image(np.random.RandomState(index))
+        while time.time() - start < self.decode_seconds:
+            pass
+        return self.transformer.preprocess('data', image)
+
+
+def benchmark_preprocess_pipeline(num_images=400, batch_size=50, worker_counts=(0, 2, 4), forward_overhead=0.02):
+    """Compare serial preprocessing with the worker pool pipeline
+    """
+
+    preprocess_item = SyntheticDecoder()
+    layer = 'fc7-food'
+    for num_workers in worker_counts:
+        net = StandInNet(forward_overhead=forward_overhead)
+        if num_workers == 0:
+            pipeline = None
+            batches = preprocess_batches(range(num_images), preprocess_item, batch_size)
+        else:
+            pipeline = PreprocessPipeline(preprocess_item, batch_size, num_workers)
+            batches = pipeline.batches(range(num_images))
+        seconds, count = time_call(lambda: sum(len(items) for items, _ in forward_batches(net, batches, [layer])))
+        assert count == num_images
+        print 'workers %2d: %8.3f s, %8.1f images/s' % (num_workers, seconds, num_images / seconds)
+        if pipeline is not None:
+            print '    ' + pipeline.stats.summary()
+
+
+def benchmark_sharded_extraction(num_images=240, batch_size=20, worker_counts=(1, 2, 4)):
+    """Compare sharded extraction with one stand-in net per worker for several worker counts
+    """
+
+    items = ['%06d.jpg' % i for i in range(num_images)]
+    labels = [str(i % 101) for i in range(num_images)]
+    decoder = SyntheticDecoder()
+    preprocess_factory = lambda net: lambda item: decoder(int(item[:6]))
+    reference = None
+    for num_workers in worker_counts:
+        output_dir = tempfile.mkdtemp()
+        try:
+            output_stores = {'fc7-food': output_dir + '/fc7'}
+            seconds, merged = time_call(extract_sharded, items, labels, output_stores, StandInNet, preprocess_factory,
+                                        num_workers, batch_size, verbose=False)
+            X, y, keys = merged['fc7-food'].to_arrays()
+            if reference is None:
+                reference = X
+            assert list(keys) == items
+            assert np.allclose(reference, X, rtol=1e-4, atol=1e-2)
+            print 'workers %2d: %8.3f s, %8.1f images/s' % (num_workers, seconds, num_images / seconds)
+        finally:
+            shutil.rmtree(output_dir)
+
+
+def benchmark_tta(num_images=64, batch_size=16, forward_overhead=0.002):
+    """Compare 10 single-crop forwards per image with one batched 10-crop forward per batch
+    """
+
+    rng = np.random.RandomState(0)
+    images = np.array([random_image(rng) for _ in range(num_images)])
+    transformer = StandInTransformer()
+    settings = {'transpose': (2, 0, 1), 'channel_swap': transformer.channel_swap,
+                'raw_scale': transformer.raw_scale, 'mean': transformer.mean}
+    layer = 'prob'
+    net = StandInNet(forward_overhead=forward_overhead)
+
+    def per_crop():
+        scores = []
+        for image in images:
+            crops = oversample(image[np.newaxis])
+            crop_scores = [forward_tta_crop(net, transformer, crop, layer) for crop in crops]
+            scores.append(np.mean(crop_scores, axis=0))
+        return np.array(scores)
+
+    def batched():
+        return np.concatenate([forward_tta(net, images[start:start + batch_size], settings, [layer])[0]
+                               for start in range(0, num_images, batch_size)])
+
+    loop_seconds, loop_scores = time_call(per_crop)
+    batch_seconds, batch_scores = time_call(batched)
+    assert np.allclose(loop_scores, batch_scores, rtol=1e-4, atol=1e-2)
+    print 'single crop loop: %8.3f s, batched tta: %8.3f s, speedup %.1fx' % (
+        loop_seconds, batch_seconds, loop_seconds / batch_seconds)
+
+
+def forward_tta_crop(net, transformer, crop, layer):
+    net.blobs['data'].reshape(1, *net.blobs['data'].data.shape[1:])
+    net.blobs['data'].data[0] = transformer.preprocess('data', crop)
+    net.forward()
+    return net.blobs[layer].data[0].copy()
+
+
+def benchmark_inference_server(num_clients=16, requests_per_client=16, batch_sizes=(1, 8, 32), forward_overhead=0.01):
+    """Throughput of the micro-batching inference server under concurrent clients
+    """
+
+    transformer = StandInTransformer()
+    image = transformer.preprocess('data', random_image(np.random.RandomState(0)))
+    preprocess = lambda path: image
+    for max_batch_size in batch_sizes:
+        net = StandInNet(forward_overhead=forward_overhead)
+        server = InferenceServer(('127.0.0.1', 0), net, preprocess, max_batch_size=max_batch_size, max_latency=0.005)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        url = 'http://%s:%d' % server.server_address
+
+        def client():
+            for _ in range(requests_per_client):
+                reply = json.loads(urllib2.urlopen(url + '/predict', json.dumps({'image': 'x.jpg', 'k': 3})).read())
+                assert len(reply['classes']) == 3
+
+        def run():
+            clients = [threading.Thread(target=client) for _ in range(num_clients)]
+            for c in clients:
+                c.start()
+            for c in clients:
+                c.join()
+
+        seconds, _ = time_call(run)
+        metrics = json.loads(urllib2.urlopen(url + '/metrics').read())
+        server.shutdown()
+        server.server_close()
+        num_requests = num_clients * requests_per_client
+        print 'max_batch_size %3d: %8.1f requests/s, mean batch %.1f, mean queue wait %.1f ms, mean inference %.1f ms' % (
+            max_batch_size, num_requests / seconds, metrics['batch_size']['mean'],
+            1000 * metrics['queue_wait_seconds']['mean'], 1000 * metrics['inference_seconds']['mean'])
+
+
+def benchmark_top_k(num_rows=25000, num_classes=101, k=5):
+    """Compare get_top_k on a score matrix with get_top_arguments in a per-row loop
+    """
+
+    scores = np.random.RandomState(0).rand(num_rows, num_classes)
+    loop_seconds, loop_indices = time_call(lambda: np.array([get_top_arguments(row, k) for row in scores]))
+    batch_seconds, (batch_indices, batch_scores) = time_call(get_top_k, scores, k)
+    assert (loop_indices == batch_indices).all()
+    assert (scores[np.arange(num_rows)[:, np.newaxis], batch_indices] == batch_scores).all()
+    ties = np.zeros((2, num_classes))
+    ties[:, ::3] = 1.0
+    assert (get_top_k(ties, k)[0] == np.arange(0, 3 * k, 3)).all()
+    print 'per-row argsort loop: %8.3f s, get_top_k: %8.3f s, speedup %.1fx' % (
+        loop_seconds, batch_seconds, loop_seconds / batch_seconds)
+
+
+def benchmark_ann_index(num_rows=20000, num_features=256, num_clusters=200, num_lists=128, num_queries=200, k=10):
+    """Recall@k and query time of the IVF index against exact search on clustered features
+    """
+
+    rng = np.random.RandomState(0)
+    centers = rng.rand(num_clusters, num_features).astype(np.float32)
+    X = np.maximum(centers[rng.randint(num_clusters, size=num_rows)] +
+                   0.3 * rng.randn(num_rows, num_features).astype(np.float32), 0)
+    directory = tempfile.mkdtemp()
+    try:
+        with FeatureStore(directory + '/store', num_features, shard_size=5000) as store:
+            store.append(['img%d.jpg' % i for i in range(num_rows)], [0] * num_rows, X)
+        build_seconds, index = time_call(build_ivf_index, directory + '/store', directory + '/index', num_lists,
+                                         normalize=True)
+        print 'built %d lists over %d rows in %.2f s' % (num_lists, num_rows, build_seconds)
+        queries = X[rng.choice(num_rows, num_queries, replace=False)]
+        with FeatureStore(directory + '/store', mode='r') as store:
+            report = evaluate_index(index, store, queries, k, nprobes=(1, 2, 4, 8, 16))
+        for line in report:
+            print 'nprobe %-5s recall@%d %.3f  %.3f ms/query' % (line['nprobe'], k, line['recall'],
+                                                                  line['ms_per_query'])
+        assert report[-1]['recall'] > 0.9
+    finally:
+        shutil.rmtree(directory)
+
+
+def benchmark_hog(num_images=64, batch_sizes=(1, 16, 64)):
+    """Compare hog_feature per image with hog_features_batch on stacks of images, and check they agree
+    """
+
+    rng = np.random.RandomState(0)
+    images = np.array([(255 * random_image(rng)).astype(np.uint8) for _ in range(num_images)])
+    # flat areas give zero gradients, whose orientation sits on a bin edge
+    images[:, :32, :32] = 128
+    loop_seconds, reference = time_call(lambda: np.array([hog_feature(image) for image in images]))
+    print 'hog_feature loop: %8.3f s' % loop_seconds
+    for batch_size in batch_sizes:
+        seconds, features = time_call(lambda: np.vstack([hog_features_batch(images[start:start + batch_size])
+                                                         for start in range(0, num_images, batch_size)]))
+        assert features.shape == reference.shape
+        assert np.allclose(features, reference, rtol=1e-10, atol=1e-10)
+        print 'hog_features_batch, batch %3d: %8.3f s, speedup %.1fx' % (batch_size, seconds, loop_seconds / seconds)
+
+
+def benchmark_color_histogram(num_images=64):
+    """Compare color_histogram_hsv per image with color_histograms_hsv on a stack, and check they agree
+    """
+
+    rng = np.random.RandomState(0)
+    images = np.array([(255 * random_image(rng)).round() for _ in range(num_images)])
+    images[:, :32, :32] = 128
+    loop_seconds, reference = time_call(lambda: np.array([color_histogram_hsv(image) for image in images]))
+    seconds, features = time_call(color_histograms_hsv, images)
+    assert np.allclose(features, reference, rtol=1e-10, atol=1e-12)
+    joint_seconds, joint = time_call(color_histograms_hsv, images, saturation_nbin=4)
+    assert np.allclose(joint.reshape(num_images, -1, 4).sum(axis=2), features)
+    print 'color_histogram_hsv loop: %8.3f s, color_histograms_hsv: %8.3f s, speedup %.1fx, joint hue/saturation: %8.3f s' % (
+        loop_seconds, seconds, loop_seconds / seconds, joint_seconds)
+
+
+def softmax_loss_loop(scores, y):
+    """The softmax loss of TwoLayerNet.loss before softmax_loss: one-hot loop and global max
+    """
+
+    N, C = scores.shape
+    y_boolean_matrix = np.zeros((N, C))
+    for i in np.arange(N):
+        y_boolean_matrix[i, y[i]] = 1
+    exp_scores_matrix = np.exp(scores - np.max(scores))
+    p_matrix = exp_scores_matrix / np.sum(exp_scores_matrix, axis=-1)[:, np.newaxis]
+    data_loss = (-1.0 * np.sum(np.log(np.sum(y_boolean_matrix * p_matrix, axis=-1)))) / N
+    return data_loss, (p_matrix - y_boolean_matrix) / N
+
+
+def benchmark_softmax_loss(batch_sizes=(256, 1024, 4096), num_classes=101, repeats=20):
+    """Compare the fused softmax_loss with the one-hot loop it replaced in TwoLayerNet.loss
+    """
+
+    rng = np.random.RandomState(0)
+    for batch_size in batch_sizes:
+        scores = rng.randn(batch_size, num_classes)
+        y = rng.randint(num_classes, size=batch_size)
+        loop_seconds, (loop_loss, loop_dscores) = time_call(
+            lambda: [softmax_loss_loop(scores, y) for _ in range(repeats)][-1])
+        fused_seconds, (loss, dscores) = time_call(lambda: [softmax_loss(scores, y) for _ in range(repeats)][-1])
+        assert np.isclose(loss, loop_loss) and np.allclose(dscores, loop_dscores)
+        print 'batch %4d: one-hot loop %7.2f ms, fused %7.2f ms, speedup %.1fx' % (
+            batch_size, 1000 * loop_seconds / repeats, 1000 * fused_seconds / repeats, loop_seconds / fused_seconds)
+    # rows far below the global max underflow in the old loss, not in the fused one
+    scores = np.array([[1000.0, 0.0], [0.0, 1.0]])
+    assert np.isfinite(softmax_loss(scores, np.array([0, 0]))[0])
+
+
+def benchmark_training_step(num_train=4096, input_size=2048, num_classes=101, batch_size=256, num_iters=20):
+    """Compare TwoLayerNet.train steps allocating fresh arrays with preallocated ones
+    """
+
+    rng = np.random.RandomState(0)
+    X = rng.randn(num_train, input_size).astype(np.float32)
+    y = rng.randint(num_classes, size=num_train)
+    final_params = []
+    for preallocate in (False, True):
+        np.random.seed(0)
+        net = TwoLayerNet(input_size, input_size, num_classes, std=1e-2)
+        stats = net.train(X, y, X[:batch_size], y[:batch_size], learning_rate=1e-3, num_iters=num_iters,
+                          batch_size=batch_size, preallocate=preallocate)
+        final_params.append(net.params)
+        # the first step allocates the workspace
+        print 'preallocate %-5s: %7.1f ms/step, %7.0f page faults/step' % (
+            preallocate, 1000 * np.mean(stats['step_time_history'][1:]), np.mean(stats['step_page_fault_history'][1:]))
+        if preallocate:
+            assert sum(stats['workspace_buffer_miss_history'][1:]) == 0
+    for name in ('W1', 'b1', 'W2', 'b2'):
+        assert np.allclose(final_params[0][name], final_params[1][name])
+
+
+def benchmark_minibatch_loader(num_train=20000, num_features=2048, hidden_size=1024, batch_size=256, num_steps=100):
+    """Time minibatch gathering plus a simulated step on a memory-mapped matrix, for every sampling mode with
+    and without prefetching
+    """
+
+    rng = np.random.RandomState(0)
+    directory = tempfile.mkdtemp()
+    try:
+        X = np.lib.format.open_memmap(directory + '/X.npy', mode='w+', dtype=np.float32,
+                                      shape=(num_train, num_features))
+        for start in range(0, num_train, 1000):
+            X[start:start + 1000] = rng.rand(min(1000, num_train - start), num_features)
+        X.flush()
+        del X
+        X = np.load(directory + '/X.npy', mmap_mode='r')
+        y = rng.randint(101, size=num_train)
+        W = rng.randn(num_features, hidden_size).astype(np.float32)
+        for sampling, prefetch in (('replacement', 0), ('epoch', 0), ('epoch', 2), ('block', 0), ('block', 2)):
+            loader = MinibatchLoader(X, y, batch_size, sampling, prefetch)
+            try:
+                def run():
+                    for step in range(num_steps):
+                        X_batch, y_batch = loader.next()
+                        X_batch.dot(W)
+                seconds, _ = time_call(run)
+            finally:
+                loader.close()
+            print 'sampling %-11s prefetch %d: %6.2f ms/step' % (sampling, prefetch, 1000 * seconds / num_steps)
+    finally:
+        shutil.rmtree(directory)
+
+
+def benchmark_validation(num_val=10000, input_size=512, hidden_size=4096, num_classes=101, num_iters=12):
+    """Compare one shot and chunked validation passes, then the validation modes of TwoLayerNet.train
+    """
+
+    rng = np.random.RandomState(0)
+    X = rng.randn(512, input_size).astype(np.float32)
+    y = rng.randint(num_classes, size=512)
+    X_val = rng.randn(num_val, input_size).astype(np.float32)
+    y_val = rng.randint(num_classes, size=num_val)
+    net = TwoLayerNet(input_size, hidden_size, num_classes, std=1e-2)
+    predictions = []
+    for name, chunk_size in (('one shot', num_val), ('chunked', net.predict_chunk_size(64 << 20))):
+        seconds, y_pred = time_call(net.predict, X_val, chunk_size)
+        # float64 copy of the chunk, hidden activations and scores
+        temporary_bytes = chunk_size * (input_size + hidden_size + num_classes) * 8
+        print 'predict %-8s (%5d rows/chunk): %6.2f s, %5d MB of temporaries' % (
+            name, chunk_size, seconds, temporary_bytes >> 20)
+        predictions.append(y_pred)
+    assert np.array_equal(predictions[0], predictions[1])
+
+    histories = []
+    for name, kwargs in (('chunked', {}),
+                         ('subsample', {'val_subsample': 1000}),
+                         ('background', {'val_background': True})):
+        np.random.seed(0)
+        net = TwoLayerNet(input_size, hidden_size, num_classes, std=1e-2)
+        seconds, stats = time_call(net.train, X, y, X_val, y_val, num_iters=num_iters, batch_size=128,
+                                   prefetch=0, **kwargs)
+        print 'train %-10s: %6.2f s, val accuracies %s' % (
+            name, seconds, ' '.join('%.4f' % acc for acc in stats['val_acc_history']))
+        histories.append(stats['val_acc_history'])
+    assert histories[0] == histories[2]
+    assert histories[1][-1] == histories[0][-1]
+
+
+def benchmark_merge_join(num_keys=2000, memory_budget=1000):
+    """Check iter_sorted_lines and merge_join_files against in-memory sorts and joins
+
+      The keys are shuffled, some are repeated on one or both sides and some
+      are in one file only. The tiny memory_budget cuts the inputs into more
+      than MAX_OPEN_RUNS runs, so the runs are merged in groups first.
+    """
+
+    rng = np.random.RandomState(0)
+    tmp_dir = tempfile.mkdtemp()
+    run_dir = os.path.join(tmp_dir, 'runs')
+    os.mkdir(run_dir)
+    try:
+        keys = ['%06d.jpg' % i for i in rng.permutation(num_keys)]
+        # every key twice in file1, every third key twice in file2, a tenth of the keys on one side only
+        lines1 = ['%s,%d,%d\n' % (key, i, copy) for i, key in enumerate(keys[num_keys // 10:]) for copy in range(2)]
+        lines2 = ['%s,%d\n' % (key, i) for i, key in enumerate(keys[:-num_keys // 10]) for _ in range(1 + (i % 3 == 0))]
+        rng.shuffle(lines1)
+        rng.shuffle(lines2)
+        file1, file2 = os.path.join(tmp_dir, 'file1.txt'), os.path.join(tmp_dir, 'file2.txt')
+        with open(file1, 'w') as f:
+            f.writelines(lines1)
+        with open(file2, 'w') as f:
+            f.writelines(lines2)
+        # a run ends once its lines reach memory_budget, so this bounds the number of runs from below
+        min_line_bytes = min(len(line) for line in lines2) + LINE_OVERHEAD_BYTES
+        assert len(lines2) // (memory_budget // min_line_bytes + 1) > MAX_OPEN_RUNS
+
+        seconds, sorted_lines = time_call(lambda: list(iter_sorted_lines(file1, memory_budget, run_dir)))
+        assert sorted(sorted_lines) == sorted(lines1)
+        assert [line.split(',')[0] for line in sorted_lines] == sorted(line.split(',')[0] for line in lines1)
+        assert not os.listdir(run_dir)
+        print 'iter_sorted_lines: %d lines in %.2f s' % (len(lines1), seconds)
+
+        values2 = {}
+        for line in lines2:
+            key, values = line.split(',', 1)
+            values2.setdefault(key, []).append(values)
+        expected = sorted(line[:-1] + ',' + values for line in lines1 for values in values2.get(line.split(',')[0], []))
+        out_file = os.path.join(tmp_dir, 'joined.txt')
+        seconds, report = time_call(merge_join_files, file1, file2, out_file, memory_budget, run_dir)
+        with open(out_file) as f:
+            joined = f.readlines()
+        assert sorted(joined) == expected
+        assert [line.split(',')[0] for line in joined] == sorted(line.split(',')[0] for line in joined)
+        assert report['matched'] == len(expected)
+        keys1 = set(line.split(',')[0] for line in lines1)
+        assert report['unmatched1'] == sorted(keys1 - set(values2))
+        assert report['unmatched2'] == sorted(set(values2) - keys1)
+        assert not os.listdir(run_dir)
+        assert sorted(os.listdir(tmp_dir)) == ['file1.txt', 'file2.txt', 'joined.txt', 'runs']
+        print 'merge_join_files: %d rows in %.2f s' % (report['matched'], seconds)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+BENCHMARKS = {
+    'ann_index': benchmark_ann_index,
+    'batched_forward': benchmark_batched_forward,
+    'color_histogram': benchmark_color_histogram,
+    'hog': benchmark_hog,
+    'inference_server': benchmark_inference_server,
+    'merge_join': benchmark_merge_join,
+    'minibatch_loader': benchmark_minibatch_loader,
+    'validation': benchmark_validation,
+    'preprocess_pipeline': benchmark_preprocess_pipeline,
+    'sharded_extraction': benchmark_sharded_extraction,
+    'softmax_loss': benchmark_softmax_loss,
+    'top_k': benchmark_top_k,
+    'training_step': benchmark_training_step,
+    'tta': benchmark_tta,
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Run micro benchmarks on a stand-in net')
+    parser.add_argument('benchmarks', nargs='*',
+                        help='Benchmarks to run, out of: ' + ', '.join(sorted(BENCHMARKS)) + ' (default: all)')
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark: ' + name)
+    return args
+
+
+def main():
+    args = parse_args()
+    for name in args.benchmarks or sorted(BENCHMARKS):
+        print '== ' + name
+        BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+    main()
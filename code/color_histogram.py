@@ -1,6 +1,10 @@
+import multiprocessing
+
 import numpy as np
 import matplotlib
 
+from descriptor_extraction import apply_by_shape, save_descriptor_features
+
 
 def color_histogram_hsv(im, nbin=10, xmin=0, xmax=255, normalized=True):
   """
@@ -24,4 +28,126 @@ def color_histogram_hsv(im, nbin=10, xmin=0, xmax=255, normalized=True):
   imhist = imhist * np.diff(bin_edges)
 
   # return histogram
-  return imhist
\ No newline at end of file
+  return imhist
+
+
+def hue_saturation(images, xmax=255, with_saturation=False):
+  """
+  Compute the hue, and optionally the saturation, of a stack of RGB images
+  exactly as matplotlib.colors.rgb_to_hsv does, without computing the
+  channels that are not needed.
+
+  Inputs:
+  - images: N x H x W x C array of pixel data for RGB or RGBA images, or
+    N x H x W array of grayscale images, which are treated as RGB images
+    with equal channels.
+  - xmax: Maximum pixel value.
+  - with_saturation: Whether to compute the saturation as well.
+
+  Returns:
+    N x H x W array of hues in [0, 1), or a tuple of hues and saturations in
+    [0, 1] if with_saturation is set.
+  """
+  images = np.asarray(images)
+  if images.ndim == 3:
+    images = np.repeat(images[..., None], 3, -1)
+  if images.ndim != 4 or images.shape[-1] not in (3, 4):
+    raise ValueError('Expected N x H x W grayscale or N x H x W x 3 (or 4) color images, got shape ' +
+                     str(images.shape))
+  rgb = images[..., :3]
+  # float images keep their precision, as in rgb_to_hsv
+  if rgb.dtype.kind != 'f':
+    rgb = rgb.astype(np.float64)
+  rgb = rgb / xmax
+  r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+  value = np.maximum(np.maximum(r, g), b)
+  delta = value - np.minimum(np.minimum(r, g), b)
+  # rgb_to_hsv assigns red, then green, then blue maxima, so blue wins ties
+  blue_max = b == value
+  green_max = (g == value) & ~blue_max
+  numerator = np.where(blue_max, r - g, np.where(green_max, b - r, g - b))
+  positive = delta > 0
+  offset = (4 * blue_max + 2 * green_max).astype(rgb.dtype)
+  hue = (offset + numerator / np.where(positive, delta, 1)) / 6.0 % 1.0
+  hue[~positive] = 0
+  if not with_saturation:
+    return hue
+  saturation = np.where(value > 0, delta / np.where(value > 0, value, 1), 0)
+  return hue, saturation
+
+
+def color_histograms_hsv(images, nbin=10, xmin=0, xmax=255, normalized=True, saturation_nbin=None):
+  """
+  Compute the hue histograms of color_histogram_hsv for a stack of images at
+  once, or joint hue / saturation histograms.
+
+  Only hue (and saturation) are computed, and the bins of all images are
+  counted with a single bincount. With saturation_nbin=None the rows match
+  color_histogram_hsv on float images.
+
+  Inputs:
+  - images: N x H x W x C array of pixel data for RGB images, or N x H x W
+    array of grayscale images; see hue_saturation.
+  - nbin: Number of hue bins.
+  - xmin: Minimum pixel value.
+  - xmax: Maximum pixel value.
+  - normalized: Whether to normalize the histograms to the fraction of
+    pixels per bin.
+  - saturation_nbin: Number of saturation bins of a joint histogram, or
+    None for hue only.
+
+  Returns:
+    N x nbin array of hue histograms, or N x (nbin * saturation_nbin) array
+    of joint histograms with the saturation bins of each hue bin adjacent.
+  """
+  if saturation_nbin is None:
+    hue = hue_saturation(images, xmax)
+  else:
+    hue, saturation = hue_saturation(images, xmax, with_saturation=True)
+  num_images = hue.shape[0]
+  bins = np.linspace(xmin, xmax, nbin+1)
+  # same bins as np.histogram: half open, except that the last one is closed
+  index = np.searchsorted(bins, hue * xmax, side='right') - 1
+  index[hue * xmax == xmax] = nbin - 1
+  valid = (index >= 0) & (index < nbin)
+  num_bins = nbin
+  if saturation_nbin is not None:
+    saturation_index = np.minimum((saturation * saturation_nbin).astype(np.intp), saturation_nbin - 1)
+    index = index * saturation_nbin + saturation_index
+    num_bins = nbin * saturation_nbin
+  index = index + num_bins * np.arange(num_images).reshape((-1,) + (1,) * (index.ndim - 1))
+  imhist = np.bincount(index[valid], minlength=num_images * num_bins).reshape(num_images, num_bins)
+  imhist = imhist.astype(np.float64)
+  if normalized:
+    imhist /= np.maximum(imhist.sum(axis=1, keepdims=True), 1)
+  elif saturation_nbin is None:
+    # color_histogram_hsv scales the counts by the bin width
+    imhist *= np.diff(bins)
+  return imhist
+
+
+def calculate_save_color_histograms(image_dir, output_store_path, label_file=None, nbin=10, saturation_nbin=None,
+                                    batch_size=64, num_workers=0):
+  """
+  Compute the color histograms of every image of a folder into a
+  FeatureStore, see descriptor_extraction.save_descriptor_features.
+
+  Inputs:
+  - image_dir: Folder holding the images.
+  - output_store_path: Path of the FeatureStore, keyed by image file name.
+  - label_file: Optional "image_file label" file.
+  - nbin, saturation_nbin: See color_histograms_hsv.
+  - batch_size: Number of images decoded and described together.
+  - num_workers: Number of worker processes, 0 for none.
+  """
+  describe_batch = lambda images: color_histograms_hsv(images, nbin, saturation_nbin=saturation_nbin)
+  describe_images = lambda images: apply_by_shape(describe_batch, images)
+  save_descriptor_features(image_dir, output_store_path, describe_images, label_file, batch_size, num_workers)
+
+
+if __name__ == '__main__':
+  num_workers = multiprocessing.cpu_count()
+  calculate_save_color_histograms('/mnt/data/train', '/mnt/data/color_features_train', '/mnt/data/train_data.txt',
+                                  num_workers=num_workers)
+  calculate_save_color_histograms('/mnt/data/test', '/mnt/data/color_features_test', '/mnt/data/test_data.txt',
+                                  num_workers=num_workers)
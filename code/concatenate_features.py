@@ -1,5 +1,13 @@
+import heapq
+import itertools
+import os
+import tempfile
+
+import numpy as np
 import pandas as pd
 
+from feature_store import FeatureStore
+
 def read_file(file_path,num_columns):
     df = pd.read_csv(file_path, sep=",",names=range(num_columns))
     return df
@@ -14,15 +22,208 @@ def write_df(merged_table,out_file):
     merged_table.to_csv(out_file, header=False,index=False)
 
 
-
-
-
-
-
-
-
-
-
-
-
-
+# rough memory taken by a line held in a list, on top of its characters
+LINE_OVERHEAD_BYTES = 100
+MAX_OPEN_RUNS = 64
+
+
+def _line_key(line):
+    comma = line.find(',')
+    return line[:comma] if comma >= 0 else line.rstrip('\n')
+
+
+def _write_run(lines, tmp_dir):
+    lines.sort(key=_line_key)
+    fd, path = tempfile.mkstemp(suffix='.run', dir=tmp_dir)
+    with os.fdopen(fd, 'w') as f:
+        f.writelines(lines)
+    return path
+
+
+def _merge_runs(run_paths, tmp_dir=None):
+    """Yield the lines of sorted run files in key order, deleting the runs when done
+    """
+    files = [open(path) for path in run_paths]
+    try:
+        keyed = [((_line_key(line), run_id, line) for line in f) for run_id, f in enumerate(files)]
+        if tmp_dir is None:
+            for key, run_id, line in heapq.merge(*keyed):
+                yield line
+        else:
+            # merge into a new run when there are too many to open at once
+            fd, path = tempfile.mkstemp(suffix='.run', dir=tmp_dir)
+            with os.fdopen(fd, 'w') as out:
+                out.writelines(line for key, run_id, line in heapq.merge(*keyed))
+            yield path
+    finally:
+        for f in files:
+            f.close()
+        for path in run_paths:
+            os.remove(path)
+
+
+def iter_sorted_lines(file_path, memory_budget=256 << 20, tmp_dir=None, presorted=False):
+    """Yield the lines of a "key,values..." text file sorted by key, using bounded memory
+
+      External merge sort: the file is cut into runs of at most memory_budget
+      bytes, every run is sorted in memory and written to a temporary file,
+      and the runs are merged lazily.
+
+      Parameters:
+        file_path : text file with one "key,values..." line per row
+        memory_budget : bytes of lines held in memory at once
+        tmp_dir : directory of the temporary run files, the system default if
+          None
+        presorted : the file is already sorted by key; it is streamed as is
+          and a ValueError is raised if a key is out of order
+
+      Returns:
+        generator of lines, each ending with a newline
+
+    """
+    if presorted:
+        previous = None
+        with open(file_path) as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    line += '\n'
+                key = _line_key(line)
+                if previous is not None and key < previous:
+                    raise ValueError("%s is not sorted: %s comes after %s" % (file_path, key, previous))
+                previous = key
+                yield line
+        return
+    run_paths = []
+    try:
+        lines = []
+        size = 0
+        with open(file_path) as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    line += '\n'
+                lines.append(line)
+                size += len(line) + LINE_OVERHEAD_BYTES
+                if size >= memory_budget:
+                    run_paths.append(_write_run(lines, tmp_dir))
+                    lines = []
+                    size = 0
+        if lines:
+            run_paths.append(_write_run(lines, tmp_dir))
+        del lines
+        while len(run_paths) > MAX_OPEN_RUNS:
+            groups = [run_paths[start:start + MAX_OPEN_RUNS] for start in range(0, len(run_paths), MAX_OPEN_RUNS)]
+            run_paths = []
+            for group in groups:
+                run_paths.extend(_merge_runs(group, tmp_dir or tempfile.gettempdir()))
+        merged = _merge_runs(run_paths)
+        run_paths = []
+        for line in merged:
+            yield line
+    finally:
+        for path in run_paths:
+            os.remove(path)
+
+
+def merge_join_files(file1, file2, out_file, memory_budget=256 << 20, tmp_dir=None, presorted=False):
+    """Inner join two "key,values..." text files on their key with bounded memory
+
+      Streaming counterpart of read_file, concatenate_df and write_df: both
+      inputs are sorted by key with iter_sorted_lines, one after the other
+      within memory_budget, and then merged line by line. Values are copied
+      as text and never parsed. Every output line is "key,values of
+      file1,values of file2"; a key repeated on both sides gives every
+      combination, as pd.merge does. Rows come out sorted by key. The output
+      is written to a temporary file and renamed into place when complete.
+
+      Parameters:
+        file1, file2 : input text files, e.g. HOG and fc7 features
+        out_file : output text file
+        memory_budget : bytes of lines held in memory while sorting
+        tmp_dir : directory of the temporary run files
+        presorted : both inputs are already sorted by key, skip the sort
+
+      Returns:
+        dict with 'matched', the number of output rows, and 'unmatched1' and
+        'unmatched2', the keys found only in file1 and only in file2
+
+    """
+    report = {'matched': 0, 'unmatched1': [], 'unmatched2': []}
+    groups1 = itertools.groupby(iter_sorted_lines(file1, memory_budget, tmp_dir, presorted), _line_key)
+    groups2 = itertools.groupby(iter_sorted_lines(file2, memory_budget, tmp_dir, presorted), _line_key)
+    tmp_out = out_file + '.%d.tmp' % os.getpid()
+    try:
+        with open(tmp_out, 'w') as out:
+            key1, lines1 = next(groups1, (None, None))
+            key2, lines2 = next(groups2, (None, None))
+            while key1 is not None and key2 is not None:
+                if key1 < key2:
+                    report['unmatched1'].append(key1)
+                    key1, lines1 = next(groups1, (None, None))
+                elif key2 < key1:
+                    report['unmatched2'].append(key2)
+                    key2, lines2 = next(groups2, (None, None))
+                else:
+                    values2 = [line[len(key2):] for line in lines2]
+                    for line1 in lines1:
+                        values1 = line1[len(key1):-1]
+                        for values in values2:
+                            out.write(key1 + values1 + values)
+                            report['matched'] += 1
+                    key1, lines1 = next(groups1, (None, None))
+                    key2, lines2 = next(groups2, (None, None))
+            while key1 is not None:
+                report['unmatched1'].append(key1)
+                key1, lines1 = next(groups1, (None, None))
+            while key2 is not None:
+                report['unmatched2'].append(key2)
+                key2, lines2 = next(groups2, (None, None))
+        os.rename(tmp_out, out_file)
+    except:
+        if os.path.exists(tmp_out):
+            os.remove(tmp_out)
+        raise
+    print "Joined %d rows, %d keys only in %s, %d keys only in %s" % (
+        report['matched'], len(report['unmatched1']), file1, len(report['unmatched2']), file2)
+    return report
+
+
+def concatenate_stores(store_paths, output_path, label_store=0, chunk_size=1000):
+    """Inner join feature stores on their keys and write the concatenated rows
+
+      Binary counterpart of read_file, concatenate_df and write_df: rows are
+      read from the memory-mapped shards of the inputs a chunk at a time, so
+      no text is formatted or parsed and no input is loaded whole. The output
+      is a single shard, so its whole matrix can be memory-mapped for
+      training (see train_concatenated_features.load_store_features).
+
+      Parameters:
+        store_paths : paths of the stores to join, e.g. HOG and fc7 features
+        output_path : path of the concatenated store; keys it already holds
+          are skipped, so an interrupted run can be rerun
+        label_store : index in store_paths of the store whose labels are kept
+        chunk_size : number of rows copied at a time
+
+      Returns:
+        the concatenated FeatureStore, opened read only
+
+    """
+    inputs = [FeatureStore(path, mode='r') for path in store_paths]
+    keys = [key for key in inputs[0].keys if all(key in store for store in inputs[1:])]
+    widths = [store.num_features for store in inputs]
+    output = FeatureStore(output_path, sum(widths), shard_size=max(len(keys), 1))
+    try:
+        pending = [key for key in keys if key not in output]
+        bounds = np.cumsum([0] + widths)
+        for start in range(0, len(pending), chunk_size):
+            chunk_keys = pending[start:start + chunk_size]
+            features = np.empty((len(chunk_keys), output.num_features), dtype=output.dtype)
+            for store, first, last in zip(inputs, bounds[:-1], bounds[1:]):
+                for i, key in enumerate(chunk_keys):
+                    features[i, first:last] = store.get(key)
+            labels = [inputs[label_store].labels[inputs[label_store].rows[key]] for key in chunk_keys]
+            output.append(chunk_keys, labels, features)
+    finally:
+        output.close()
+        for store in inputs:
+            store.close()
+    return FeatureStore(output_path, mode='r')
@@ -0,0 +1,109 @@
+import cPickle
+import os
+
+import numpy as np
+
+from feature_store import FeatureStore
+from labels import get_label_dict
+
+
+def _append_new_rows(store, keys, labels, features):
+    """Append the rows whose keys the store does not hold yet, keeping the first of repeated keys
+    """
+    seen = set()
+    kept = []
+    for i, key in enumerate(keys):
+        if key not in store and key not in seen:
+            seen.add(key)
+            kept.append(i)
+    if kept:
+        store.append([keys[i] for i in kept], [labels[i] for i in kept], np.asarray(features)[kept])
+    return len(kept)
+
+
+def convert_pickle(pickle_path, store_path, shard_size=10000, chunk_size=10000):
+    """Convert a pickled (X, y, image_files) tuple, as the old get_features wrote it, to a FeatureStore
+
+      Rows of X past the last image file, left at zero by a run that skipped
+      unlabelled images, are dropped.
+
+      Parameters:
+        pickle_path : path of the pickle, e.g. /mnt/data/f7_features_train.p
+        store_path : path of the FeatureStore; rows it already holds are
+          skipped, so an interrupted conversion can be rerun
+        shard_size : rows per shard of a new store
+        chunk_size : rows appended at a time
+
+      Returns:
+        the FeatureStore, opened read only
+
+    """
+    with open(pickle_path, 'rb') as f:
+        X, y, image_files = cPickle.load(f)
+    keys = [str(image_file) for image_file in image_files]
+    with FeatureStore(store_path, X.shape[1], shard_size=shard_size) as store:
+        for start in range(0, len(keys), chunk_size):
+            stop = start + chunk_size
+            _append_new_rows(store, keys[start:stop], list(y[start:stop]), X[start:min(stop, len(keys))])
+    return FeatureStore(store_path, mode='r')
+
+
+def convert_text(text_path, store_path, label_file=None, shard_size=10000, chunk_size=1000):
+    """Convert a "key,v1,...,vD" text file to a FeatureStore
+
+      Reads the comma-joined output of the old hog_features as well as the
+      headerless CSV of concatenate_features.write_df and merge_join_files.
+      Lines are parsed one chunk at a time with np.fromstring, so the file is
+      never loaded whole.
+
+      Parameters:
+        text_path : path of the text file
+        store_path : path of the FeatureStore; rows it already holds are
+          skipped, so an interrupted conversion can be rerun
+        label_file : optional "image_file label" file; without it, or for
+          keys it does not list, rows are labelled -1
+        shard_size : rows per shard of a new store
+        chunk_size : lines parsed and appended at a time
+
+      Returns:
+        the FeatureStore, opened read only
+
+    """
+    labels_dict = get_label_dict(label_file) if label_file is not None else {}
+    store = None
+    try:
+        with open(text_path) as f:
+            while True:
+                keys = []
+                rows = []
+                for line in f:
+                    key, _, values = line.rstrip('\n').partition(',')
+                    if not values:
+                        continue
+                    keys.append(key)
+                    rows.append(np.fromstring(values, dtype=np.float32, sep=','))
+                    if len(keys) == chunk_size:
+                        break
+                if not keys:
+                    break
+                if store is None:
+                    store = FeatureStore(store_path, len(rows[0]), shard_size=shard_size)
+                if any(len(row) != store.num_features for row in rows):
+                    raise ValueError("%s: expected %d values per line near %s" % (text_path, store.num_features,
+                                                                                  keys[0]))
+                _append_new_rows(store, keys, [labels_dict.get(key, -1) for key in keys], np.array(rows))
+    finally:
+        if store is not None:
+            store.close()
+    if store is None:
+        raise ValueError("No feature rows in " + text_path)
+    return FeatureStore(store_path, mode='r')
+
+
+if __name__ == '__main__':
+    for split in ['train', 'test']:
+        label_file = '/mnt/data/' + split + '_data.txt'
+        if os.path.isfile('/mnt/data/f7_features_' + split + '.p'):
+            convert_pickle('/mnt/data/f7_features_' + split + '.p', '/mnt/data/f7_features_' + split)
+        if os.path.isfile('/mnt/data/hog_features_' + split + '.txt'):
+            convert_text('/mnt/data/hog_features_' + split + '.txt', '/mnt/data/hog_features_' + split, label_file)
@@ -0,0 +1,207 @@
+import itertools
+import os
+
+import numpy as np
+from scipy import misc
+
+from batch_features import forward_batch_layers, validate_layers
+from feature_store import FeatureStore, append_to_stores
+from labels import get_label_dict
+from worker_pool import imap_bounded, make_pool, set_worker_state, worker_state
+
+
+def apply_by_shape(describe_batch, images):
+    """Run a descriptor for stacks of same-sized images on a list of images
+
+      Parameters:
+        describe_batch : callable mapping an N x H x W (x C) stack to an
+          N x D matrix
+        images : list of images, possibly of different sizes
+
+      Returns:
+        len(images) x D matrix in the order of images
+
+    """
+    by_shape = {}
+    for i, image in enumerate(images):
+        by_shape.setdefault(image.shape, []).append(i)
+    features = None
+    for indices in by_shape.values():
+        rows = describe_batch(np.array([images[i] for i in indices]))
+        if features is None:
+            features = np.empty((len(images), rows.shape[1]), dtype=rows.dtype)
+        features[indices] = rows
+    return features
+
+
+def as_rgb_image(image):
+    """Convert a decoded grayscale, RGB or RGBA image to an RGB image of the same dtype
+
+      Food-101 holds some grayscale JPEGs, which misc.imread decodes to
+      H x W arrays; their gray value is repeated over the three channels.
+      The alpha channel of RGBA images is dropped.
+
+      Parameters:
+        image : H x W, H x W x 3 or H x W x 4 image
+
+      Returns:
+        H x W x 3 image
+
+    """
+    image = np.asarray(image)
+    if image.ndim == 2:
+        image = np.repeat(image[..., None], 3, -1)
+    if image.ndim != 3 or image.shape[2] not in (3, 4):
+        raise ValueError("Expected a grayscale, RGB or RGBA image, got shape " + str(image.shape))
+    return image[:, :, :3]
+
+
+def as_float_image(image):
+    """Convert a decoded image to the float RGB image caffe.io.load_image returns
+
+      Parameters:
+        image : H x W, H x W x 3 or H x W x 4 uint8 image, e.g. from misc.imread
+
+      Returns:
+        H x W x 3 float32 image with values in [0, 1]
+
+    """
+    image = as_rgb_image(image)
+    if image.dtype == np.uint8:
+        return image.astype(np.float32) / 255
+    return image.astype(np.float32)
+
+
+def make_preprocess_image(transformer):
+    """Return a preprocess_image callable feeding decoded images to a caffe.io.Transformer
+    """
+    return lambda image: transformer.preprocess('data', as_float_image(image))
+
+
+def _describe_chunk(task):
+    image_dir, img_files = task
+    state = worker_state()
+    # every descriptor and the net see RGB images, whatever the file holds
+    images = [as_rgb_image(misc.imread(os.path.join(image_dir, img_file))) for img_file in img_files]
+    features = dict((name, np.asarray(describe_images(images), dtype=np.float32))
+                    for name, describe_images in state['describers'].items())
+    data = None
+    if state['preprocess_image'] is not None:
+        data = np.array([state['preprocess_image'](image) for image in images], dtype=np.float32)
+    return img_files, features, data
+
+
+def extract_descriptors(image_dir, output_stores, describers=None, net=None, preprocess_image=None,
+                        label_file=None, batch_size=64, num_workers=0, max_queued_chunks=None):
+    """Decode every image of a folder once and compute several descriptors from it
+
+      Each chunk of batch_size images is decoded once, then handed to every
+      descriptor in describers and, if output_stores names blobs of net,
+      preprocessed for the net and run through one forward pass. Each
+      descriptor and blob is written to its own FeatureStore. All the stores
+      get every chunk in the same order, so their rows are aligned, and an
+      interrupted run resumes with the images some store is missing.
+
+      Parameters:
+        image_dir : folder holding the images
+        output_stores : dict mapping descriptor names and blob names to store
+          paths
+        describers : dict mapping descriptor names to callables that map a
+          list of decoded H x W x 3 images (see as_rgb_image) to an N x D
+          matrix, e.g.
+          hog_features.hog_features_of_images
+        net : caffe.Net or any object with the same blobs interface, needed
+          when output_stores names blobs
+        preprocess_image : callable mapping a decoded image to the input of
+          the data blob, needed with net
+        label_file : optional "image_file label" file; only the labelled
+          images are processed. Without it every image is processed and
+          labelled -1.
+        batch_size : number of images decoded, described and forwarded together
+        num_workers : number of processes decoding, describing and
+          preprocessing chunks, 0 to do it on the main process; the
+          callables need not be picklable (see worker_pool.make_pool). The
+          forward passes run on the main process.
+        max_queued_chunks : bound on chunks being described or waiting for
+          the main process, 2 * num_workers by default. Each waiting chunk
+          holds its preprocessed net input, so this bounds the memory when
+          the forward passes are slower than the workers.
+
+    """
+    describers = dict((name, describe_images) for name, describe_images in (describers or {}).items()
+                      if name in output_stores)
+    layers = sorted(name for name in output_stores if name not in describers)
+    if layers:
+        if net is None or preprocess_image is None:
+            raise ValueError("net and preprocess_image are needed for " + ", ".join(layers))
+        validate_layers(net, layers)
+    else:
+        preprocess_image = None
+    names = sorted(describers) + layers
+    if not names:
+        raise ValueError("No descriptors or blobs to extract")
+    labels_dict = get_label_dict(label_file) if label_file is not None else None
+    processed_files = None
+    for name in names:
+        if os.path.isdir(output_stores[name]):
+            with FeatureStore(output_stores[name], mode='r') as store:
+                keys = set(store.keys)
+        else:
+            keys = set()
+        processed_files = keys if processed_files is None else processed_files & keys
+    list_img_files = [img_file for img_file in sorted(os.listdir(image_dir))
+                      if (labels_dict is None or img_file in labels_dict) and img_file not in processed_files]
+    print "Files to process : " + str(len(list_img_files))
+    chunks = [(image_dir, list_img_files[start:start + batch_size])
+              for start in range(0, len(list_img_files), batch_size)]
+    state = {'describers': describers, 'preprocess_image': preprocess_image}
+    pool = None
+    stores = None
+    try:
+        if num_workers > 0:
+            pool = make_pool(num_workers, state)
+            results = imap_bounded(pool, _describe_chunk, chunks, max_queued_chunks or 2 * num_workers)
+        else:
+            set_worker_state(state)
+            results = itertools.imap(_describe_chunk, chunks)
+        count_files = 0
+        for batch_files, features, data in results:
+            batch_features = [features[name] for name in sorted(describers)]
+            if layers:
+                batch_features += forward_batch_layers(net, data, layers)
+            if stores is None:
+                stores = [FeatureStore(output_stores[name], rows.shape[1])
+                          for name, rows in zip(names, batch_features)]
+            labels = [labels_dict[img_file] if labels_dict is not None else -1 for img_file in batch_files]
+            append_to_stores(stores, batch_files, labels, batch_features)
+            count_files += len(batch_files)
+            print "Number of Files Processed : " + str(count_files)
+    except Exception as e:
+        print e.message
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        for store in stores or []:
+            store.close()
+
+
+def save_descriptor_features(image_dir, output_store_path, describe_images, label_file=None, batch_size=64,
+                             num_workers=0):
+    """Compute a single descriptor for every image of a folder into a FeatureStore
+
+      The images are split into chunks of batch_size. Every finished chunk
+      is appended to the store and committed to its index in one step, so
+      the index only names complete chunks. An interrupted run resumes from
+      the keys of the index, which is all it reads of the output.
+
+      Parameters:
+        image_dir : folder holding the images
+        output_store_path : path of the FeatureStore, keyed by image file name
+        describe_images : callable mapping a list of decoded images to an
+          N x D matrix, e.g. hog_features_of_images
+        label_file, batch_size, num_workers : see extract_descriptors
+
+    """
+    extract_descriptors(image_dir, {'features': output_store_path}, {'features': describe_images},
+                        label_file=label_file, batch_size=batch_size, num_workers=num_workers)
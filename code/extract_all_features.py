@@ -0,0 +1,53 @@
+import multiprocessing
+
+from color_histogram import color_histograms_hsv
+from descriptor_extraction import apply_by_shape, extract_descriptors, make_preprocess_image
+from get_features import default_extractor
+from hog_features import hog_features_of_images
+
+
+def color_histograms_of_images(images):
+    return apply_by_shape(color_histograms_hsv, images)
+
+
+DESCRIBERS = {'hog': hog_features_of_images,
+              'color': color_histograms_of_images}
+
+
+def extract_all_features(image_dir, output_stores, label_file=None, batch_size=50, num_workers=0,
+                         extractor=default_extractor):
+    """Extract HOG, color histograms and CNN layers in one pass over the images
+
+      Every image is decoded once; see descriptor_extraction.extract_descriptors.
+
+      Parameters:
+        image_dir : folder holding the images
+        output_stores : dict mapping 'hog', 'color' and blob names of the
+          extractor net to store paths; any subset works and the net is only
+          loaded if blobs are named
+        label_file : optional "image_file label" file
+        batch_size : number of images per chunk and per forward pass
+        num_workers : number of decoding and describing processes
+        extractor : FeatureExtractor providing the net and the transformer
+
+    """
+    net = None
+    preprocess_image = None
+    if any(name not in DESCRIBERS for name in output_stores):
+        # build the transformer before the workers fork
+        extractor.load()
+        net = extractor.net
+        preprocess_image = make_preprocess_image(extractor.transformer)
+    extract_descriptors(image_dir, output_stores, DESCRIBERS, net, preprocess_image, label_file, batch_size,
+                        num_workers)
+
+
+if __name__ == '__main__':
+    num_workers = multiprocessing.cpu_count()
+    for split in ['train', 'test']:
+        output_stores = {'hog': '/mnt/data/hog_features_' + split,
+                         'color': '/mnt/data/color_features_' + split,
+                         'fc7-food': '/mnt/data/f7_features_' + split}
+        extract_all_features('/mnt/data/' + split, output_stores, '/mnt/data/' + split + '_data.txt',
+                             num_workers=num_workers)
+        print default_extractor.startup_report()
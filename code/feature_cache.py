@@ -0,0 +1,140 @@
+import collections
+import hashlib
+import os
+
+import numpy as np
+
+
+def file_hash(path, block_size=1 << 20):
+    """Return the sha1 hex digest of the bytes of a file
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        block = f.read(block_size)
+        while block:
+            digest.update(block)
+            block = f.read(block_size)
+    return digest.hexdigest()
+
+
+def model_hash(model_files):
+    """Return one sha1 hex digest for a set of files, e.g. a caffemodel and its prototxt
+    """
+    digest = hashlib.sha1()
+    for path in model_files:
+        digest.update(file_hash(path))
+    return digest.hexdigest()
+
+
+class FeatureCache(object):
+    """
+    Content-addressed cache of per-image layer activations with LRU eviction.
+
+    An entry is stored as cache_dir/<model hash>/<layer>/<image hash>.npy,
+    where the image hash covers the bytes of the image file and the model
+    hash covers the caffemodel and prototxt. Renaming or copying an image
+    keeps its entry; changing its pixels or the weights misses.
+
+    The total size of the .npy files under cache_dir is kept below
+    max_bytes by deleting the least recently used entries. Recency survives
+    restarts because hits touch the modification time of their file.
+    """
+
+    def __init__(self, cache_dir, model_files, max_bytes=2 << 30):
+        """
+        Inputs:
+        - cache_dir: Root directory of the cache; it may be shared by several
+          models.
+        - model_files: Files whose bytes identify the model, usually the
+          caffemodel and the deploy prototxt.
+        - max_bytes: Size budget of the whole cache directory.
+        """
+        self.cache_dir = cache_dir
+        self.model_hash = model_hash(model_files)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._image_hashes = {}
+        self._entries = collections.OrderedDict()
+        self.total_bytes = 0
+        self._scan()
+        self._evict()
+
+    def _scan(self):
+        entries = []
+        for root, dirs, files in os.walk(self.cache_dir):
+            for name in files:
+                if not name.endswith('.npy'):
+                    continue
+                path = os.path.join(root, name)
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, path, stat.st_size))
+        for mtime, path, size in sorted(entries):
+            self._entries[path] = size
+            self.total_bytes += size
+
+    def image_hash(self, image_path):
+        stat = os.stat(image_path)
+        memo_key = (image_path, stat.st_mtime, stat.st_size)
+        if memo_key not in self._image_hashes:
+            self._image_hashes[memo_key] = file_hash(image_path)
+        return self._image_hashes[memo_key]
+
+    def entry_path(self, image_path, layer):
+        return os.path.join(self.cache_dir, self.model_hash, layer.replace('/', '_'),
+                            self.image_hash(image_path) + '.npy')
+
+    def get(self, image_path, layer):
+        """
+        Return the cached activations of layer for an image, or None.
+        """
+        path = self.entry_path(image_path, layer)
+        if path not in self._entries:
+            self.misses += 1
+            return None
+        try:
+            features = np.load(path)
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            # deleted or truncated behind our back
+            self.total_bytes -= self._entries.pop(path)
+            self.misses += 1
+            return None
+        self._entries[path] = self._entries.pop(path)
+        self.hits += 1
+        return features
+
+    def put(self, image_path, layer, features):
+        """
+        Store the activations of layer for an image and evict old entries if
+        the cache is over budget.
+        """
+        path = self.entry_path(image_path, layer)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp_path = path + '.%d.tmp' % os.getpid()
+        with open(tmp_path, 'wb') as f:
+            np.save(f, np.asarray(features))
+        os.rename(tmp_path, path)
+        if path in self._entries:
+            self.total_bytes -= self._entries.pop(path)
+        size = os.path.getsize(path)
+        self._entries[path] = size
+        self.total_bytes += size
+        self._evict()
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+            path, size = self._entries.popitem(last=False)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self.total_bytes -= size
+            self.evictions += 1
+
+    def summary(self):
+        return 'feature cache: %d entries, %.1f MB, %d hits, %d misses, %d evictions' % (
+            len(self._entries), self.total_bytes / float(1 << 20), self.hits, self.misses, self.evictions)
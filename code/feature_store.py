@@ -0,0 +1,297 @@
+import json
+import os
+
+import numpy as np
+
+META_FILE = 'meta.json'
+INDEX_FILE = 'index.txt'
+SHARD_FILE = 'shard_%05d.npy'
+
+
+class FeatureStore(object):
+    """
+    Appendable on-disk store of feature rows keyed by file name.
+
+    A store is a directory holding:
+
+    meta.json: number of features per row, dtype and rows per shard
+    shard_XXXXX.npy: fixed size .npy matrices holding the rows, written and
+      read through memory maps so neither side needs the full matrix in RAM
+    index.txt: one "key label" line per stored row, in row order
+
+    Rows are written to their shard and flushed before their index lines are
+    appended, so the index only ever names rows whose data is on disk. After a
+    crash the store is reopened in append mode, the keys in the index are
+    skipped, and any row written past the end of the index is overwritten.
+    """
+
+    def __init__(self, path, num_features=None, dtype=np.float32, shard_size=10000, mode='a'):
+        """
+        Open the store at path, creating it in append mode if it does not exist.
+
+        Inputs:
+        - path: Directory of the store.
+        - num_features: Number of features per row; required to create a
+          store, checked against the stored value otherwise.
+        - dtype: Dtype of the stored rows, used when creating a store.
+        - shard_size: Number of rows per shard, used when creating a store.
+        - mode: 'a' to append to (or create) the store, 'r' for read only.
+        """
+        if mode not in ('a', 'r'):
+            raise ValueError("Invalid mode: " + str(mode))
+        self.path = path
+        self.mode = mode
+        meta_path = os.path.join(path, META_FILE)
+        if os.path.isfile(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if num_features is not None and num_features != meta['num_features']:
+                raise ValueError("Store %s has %d features, not %d" % (path, meta['num_features'], num_features))
+        else:
+            if mode == 'r':
+                raise IOError("No feature store at " + path)
+            if num_features is None:
+                raise ValueError("num_features is required to create a feature store")
+            meta = {'num_features': int(num_features), 'dtype': np.dtype(dtype).name,
+                    'shard_size': int(shard_size)}
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            with open(meta_path, 'w') as f:
+                json.dump(meta, f)
+        self.meta = meta
+        self.num_features = meta['num_features']
+        self.dtype = np.dtype(meta['dtype'])
+        self.shard_size = meta['shard_size']
+        self.keys = []
+        self.labels = []
+        self.rows = {}
+        self._shards = {}
+        self._index_file = None
+        self._read_index()
+
+    def _read_index(self):
+        index_path = os.path.join(self.path, INDEX_FILE)
+        if not os.path.isfile(index_path):
+            return
+        with open(index_path) as f:
+            content = f.read()
+        if content and not content.endswith('\n'):
+            # drop a line cut short by a crash
+            content = content[:content.rfind('\n') + 1]
+            if self.mode == 'a':
+                with open(index_path, 'r+') as f:
+                    f.truncate(len(content))
+        for line in content.splitlines():
+            key, label = line.rsplit(' ', 1)
+            self.rows[key] = len(self.keys)
+            self.keys.append(key)
+            self.labels.append(label)
+
+    def __len__(self):
+        return len(self.keys)
+
+    @property
+    def shape(self):
+        """
+        Shape (N, num_features) of the stored matrix, so a store can stand in
+        for a matrix wherever rows are read with read_rows.
+        """
+        return len(self.keys), self.num_features
+
+    def __contains__(self, key):
+        return key in self.rows
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def num_shards(self):
+        return (len(self.keys) + self.shard_size - 1) // self.shard_size
+
+    def _shard_path(self, shard_id):
+        return os.path.join(self.path, SHARD_FILE % shard_id)
+
+    def _shard(self, shard_id):
+        if shard_id not in self._shards:
+            shard_path = self._shard_path(shard_id)
+            if os.path.isfile(shard_path):
+                mmap_mode = 'r+' if self.mode == 'a' else 'r'
+                self._shards[shard_id] = np.load(shard_path, mmap_mode=mmap_mode)
+            elif self.mode == 'a':
+                self._shards[shard_id] = np.lib.format.open_memmap(
+                    shard_path, mode='w+', dtype=self.dtype, shape=(self.shard_size, self.num_features))
+            else:
+                raise IOError("Missing shard " + shard_path)
+        return self._shards[shard_id]
+
+    def append(self, keys, labels, features):
+        """
+        Append rows to the store and commit them to the index.
+
+        Inputs:
+        - keys: Sequence of N keys that are not in the store yet.
+        - labels: Sequence of N labels.
+        - features: Array of shape (N, num_features); it is cast to the dtype
+          of the store.
+        """
+        if self.mode != 'a':
+            raise IOError("Feature store %s is read only" % self.path)
+        num_rows = len(keys)
+        if len(labels) != num_rows or features.shape != (num_rows, self.num_features):
+            raise ValueError("Expected %d labels and a (%d, %d) feature matrix" %
+                             (num_rows, num_rows, self.num_features))
+        for key in keys:
+            if key in self.rows:
+                raise ValueError("Key already stored: " + key)
+        row = len(self.keys)
+        written = 0
+        while written < num_rows:
+            shard_id, offset = divmod(row + written, self.shard_size)
+            count = min(self.shard_size - offset, num_rows - written)
+            shard = self._shard(shard_id)
+            shard[offset:offset + count] = features[written:written + count]
+            shard.flush()
+            written += count
+        if self._index_file is None:
+            self._index_file = open(os.path.join(self.path, INDEX_FILE), 'a')
+        self._index_file.write(''.join('%s %s\n' % (key, label) for key, label in zip(keys, labels)))
+        self._index_file.flush()
+        for key, label in zip(keys, labels):
+            self.rows[key] = len(self.keys)
+            self.keys.append(key)
+            self.labels.append(str(label))
+
+    def close(self):
+        if self._index_file is not None:
+            self._index_file.close()
+            self._index_file = None
+        for shard in self._shards.values():
+            if self.mode == 'a':
+                shard.flush()
+        self._shards = {}
+
+    def shard_rows(self, shard_id):
+        """
+        Return a memory-mapped view of the stored rows of one shard.
+        """
+        start = shard_id * self.shard_size
+        stop = min(start + self.shard_size, len(self.keys))
+        if stop <= start:
+            raise IndexError("Shard %d is empty" % shard_id)
+        return self._shard(shard_id)[:stop - start]
+
+    def iter_shards(self):
+        """
+        Yield (start_row, rows) for every shard, where rows is a memory-mapped
+        view of the stored rows of that shard.
+        """
+        for shard_id in range(self.num_shards()):
+            yield shard_id * self.shard_size, self.shard_rows(shard_id)
+
+    def read_rows(self, start, stop):
+        """
+        Return the rows in [start, stop) as an array of shape
+        (stop - start, num_features). Rows within one shard come back as a
+        memory-mapped view; a range spanning shards is copied.
+        """
+        stop = min(stop, len(self.keys))
+        first_shard, first_offset = divmod(start, self.shard_size)
+        if stop <= start:
+            return np.zeros((0, self.num_features), dtype=self.dtype)
+        if first_offset + stop - start <= self.shard_size:
+            return self._shard(first_shard)[first_offset:first_offset + stop - start]
+        out = np.empty((stop - start, self.num_features), dtype=self.dtype)
+        row = start
+        while row < stop:
+            shard_id, offset = divmod(row, self.shard_size)
+            count = min(self.shard_size - offset, stop - row)
+            out[row - start:row - start + count] = self._shard(shard_id)[offset:offset + count]
+            row += count
+        return out
+
+    def get(self, key):
+        """
+        Return the feature row stored for key.
+        """
+        shard_id, offset = divmod(self.rows[key], self.shard_size)
+        return self._shard(shard_id)[offset]
+
+    def label_array(self, dtype=int):
+        return np.array(self.labels, dtype=dtype)
+
+    def to_arrays(self):
+        """
+        Load the whole store into memory.
+
+        Returns a tuple of:
+        - X: Array of shape (N, num_features).
+        - y: Array of shape (N,) holding the labels as strings.
+        - keys: Array of shape (N,) holding the keys.
+        """
+        return np.array(self.read_rows(0, len(self.keys))), np.array(self.labels), np.array(self.keys)
+
+
+def append_to_stores(stores, keys, labels, features_per_store):
+    """
+    Append one batch of rows to several stores that share their keys, e.g. the
+    layers of one forward pass. Keys a store already holds (because a crash
+    hit between two stores) are skipped for that store only.
+
+    Inputs:
+    - stores: List of FeatureStore objects.
+    - keys: Sequence of N keys.
+    - labels: Sequence of N labels.
+    - features_per_store: List with one (N, num_features) array per store.
+    """
+    for store, features in zip(stores, features_per_store):
+        missing_rows = [i for i, key in enumerate(keys) if key not in store]
+        if len(missing_rows) < len(keys):
+            features = features[missing_rows]
+        store.append([keys[i] for i in missing_rows], [labels[i] for i in missing_rows], features)
+
+
+def merge_stores(input_paths, output_path, key_order=None, chunk_size=1000):
+    """
+    Merge several stores with disjoint keys into a new store.
+
+    Inputs:
+    - input_paths: Paths of the stores to merge; they must have the same
+      number of features.
+    - output_path: Path of the merged store. Keys it already holds are
+      skipped, so an interrupted merge can be rerun.
+    - key_order: Optional sequence of keys giving the row order of the merged
+      store; keys that are not stored anywhere are ignored. By default the
+      rows of the inputs are concatenated in the order of input_paths.
+    - chunk_size: Number of rows copied at a time.
+
+    Returns the merged FeatureStore, opened read only.
+    """
+    inputs = [FeatureStore(path, mode='r') for path in input_paths]
+    if not inputs:
+        raise ValueError("No stores to merge")
+    if key_order is None:
+        key_order = [key for store in inputs for key in store.keys]
+    location = {}
+    for store_id, store in enumerate(inputs):
+        for key, row in store.rows.items():
+            location[key] = (store_id, row)
+    output = FeatureStore(output_path, inputs[0].num_features, dtype=inputs[0].dtype,
+                          shard_size=inputs[0].shard_size)
+    try:
+        pending = [key for key in key_order if key in location and key not in output]
+        for start in range(0, len(pending), chunk_size):
+            keys = pending[start:start + chunk_size]
+            features = np.empty((len(keys), output.num_features), dtype=output.dtype)
+            labels = []
+            for i, key in enumerate(keys):
+                store_id, row = location[key]
+                features[i] = inputs[store_id].get(key)
+                labels.append(inputs[store_id].labels[row])
+            output.append(keys, labels, features)
+    finally:
+        output.close()
+        for store in inputs:
+            store.close()
+    return FeatureStore(output_path, mode='r')
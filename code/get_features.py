@@ -1,30 +1,22 @@
+import collections
 import os
+import time
 
-import caffe
 import numpy as np
-import cPickle
+
+from batch_features import forward_batch, forward_batches, get_num_features, preprocess_batches, validate_layers
+from feature_cache import FeatureCache
+from feature_store import FeatureStore, append_to_stores
+from input_cache import PreprocessedImageCache
+from labels import get_label_dict
+from preprocess_pipeline import PreprocessPipeline
+from sharded_extraction import extract_sharded
+from tta import IMAGE_DIMS, forward_tta, forward_tta_batches
 
 model_file = '/mnt/data/Training_Snapshot/snapshot5/bvlc_caffenet_iter_8000.caffemodel'
 deploy_prototxt = '/mnt/data/Training_Snapshot/snapshot5/deploy.prototxt'
 imagemean_file = '/mnt/data/mean_all.npy'
-
-net = caffe.Net(deploy_prototxt, model_file, caffe.TEST)
 layer = 'fc7-food'
-if layer not in net.blobs:
-    raise TypeError("Invalid layer name: " + layer)
-print net.blobs['data'].data.shape
-transformer = caffe.io.Transformer({'data': net.blobs['data'].data.shape})
-transformer.set_mean('data', np.load(imagemean_file).mean(1).mean(1))
-transformer.set_transpose('data', (2, 0, 1))
-transformer.set_channel_swap('data', (2, 1, 0))
-transformer.set_raw_scale('data', 255.0)
-net.blobs['data'].reshape(1, 3, 227, 227)
-num_features_out=net.blobs[layer].data.shape[1]
-
-def get_label_dict(label_file):
-    lines= open(label_file).read().splitlines()
-    dict_labels={ x.split(' ')[0].strip() : x.split(' ')[1].strip() for x in lines}
-    return dict_labels
 
 def get_files_processed(output_file):
     if os.path.isfile(output_file) is False:
@@ -34,32 +26,58 @@ def get_files_processed(output_file):
     return files
 
 
-def save_features_for_all_files(input_image_folder,label_file,output_file):
-    labels_dict=get_label_dict(label_file)
-    list_img_files = os.listdir(input_image_folder)
-    out_file = open(output_file, mode='wb')
-    X =np.zeros((len(list_img_files),num_features_out))
-    y=[]
-    image_files=[]
-    try:
-        count_files= 0
-        for img_file in list_img_files:
-            if img_file not in labels_dict:
-                continue
-            image_features= get_image_features(img_file, input_image_folder)
-            np.copyto(X[count_files,:],image_features)
-            y.append(labels_dict[img_file])
-            image_files.append(img_file)
-            print "File Processed : "+ os.path.join(input_image_folder,img_file)
-            count_files += 1
-            if count_files %100 == 0:
-                print "Number of Files Processed : " + str(count_files)
-
-    except Exception as e:
-        print e.message
-    finally:
-        cPickle.dump((X,np.array(y),np.array(image_files)), out_file, protocol=cPickle.HIGHEST_PROTOCOL)
-        out_file.close()
+def take_cached_features(img_files, input_image_folder, layers, stores, feature_cache, labels_dict, chunk_size=64):
+    """Append the images whose layers are all in the feature cache and return the others
+
+      The cached rows are appended chunk_size images at a time, since every
+      append flushes the shards and the index of each store.
+
+    """
+    uncached_files = []
+    hit_files = []
+    hit_features = [[] for _ in layers]
+
+    def append_hits():
+        append_to_stores(stores, hit_files, [labels_dict[img_file] for img_file in hit_files],
+                         [np.vstack(rows) for rows in hit_features])
+        del hit_files[:]
+        for rows in hit_features:
+            del rows[:]
+
+    for img_file in img_files:
+        image_path = os.path.join(input_image_folder, img_file)
+        if not os.path.isfile(image_path):
+            uncached_files.append(img_file)
+            continue
+        cached_features = []
+        for name in layers:
+            features = feature_cache.get(image_path, name)
+            if features is None:
+                break
+            cached_features.append(features.reshape(1, -1))
+        if len(cached_features) == len(layers):
+            hit_files.append(img_file)
+            for rows, features in zip(hit_features, cached_features):
+                rows.append(features)
+            if len(hit_files) == chunk_size:
+                append_hits()
+        else:
+            uncached_files.append(img_file)
+    if hit_files:
+        append_hits()
+    return uncached_files
+
+
+def put_cached_features(batch_files, input_image_folder, layers, batch_features, feature_cache):
+    for i, img_file in enumerate(batch_files):
+        image_path = os.path.join(input_image_folder, img_file)
+        for name, features in zip(layers, batch_features):
+            feature_cache.put(image_path, name, features[i])
+
+
+def _import_caffe():
+    import caffe
+    return caffe
 
 
 def get_top_arguments(numpy_array,num_arguments=5):
@@ -67,19 +85,374 @@ def get_top_arguments(numpy_array,num_arguments=5):
     return sorted_arguments
 
 
-def get_image_features(image_file, image_folder):
-    complete_input_image_path = os.path.join(image_folder, image_file)
-    if os.path.isfile(complete_input_image_path) is False:
-        print "Incorrect path : " + complete_input_image_path
-        return
-    img = caffe.io.load_image(complete_input_image_path)
-    net.blobs['data'].data[...] = transformer.preprocess('data', img)
-    output = net.forward()
-    return net.blobs[layer].data[0]
+def get_top_k(scores, k=5):
+    """Return the k best classes and their scores for every row of a score matrix
+
+      Uses argpartition to find the k winners of every row in linear time and
+      only sorts those k. Equal scores are ordered by class index, lowest
+      first, including at the k-th place, so the result does not depend on
+      the partitioning.
+
+      Parameters:
+        scores : N x C score matrix, or a single score vector of length C
+        k : number of classes to return, at least 1; a k above C is clamped
+          to C, so every class is returned
+
+      Returns:
+        (indices, top_scores), both N x min(k, C) (or of length min(k, C)
+        for a vector input), best class first
+
+    """
+    if k < 1:
+        raise ValueError("k must be at least 1, got %s" % k)
+    scores = np.asarray(scores)
+    is_vector = scores.ndim == 1
+    scores = np.atleast_2d(scores)
+    num_rows, num_classes = scores.shape
+    k = min(k, num_classes)
+    rows = np.arange(num_rows)[:, np.newaxis]
+    if k == 0:
+        # no classes at all
+        indices = np.zeros((num_rows, 0), dtype=np.intp)
+        top_scores = scores[:, :0]
+        if is_vector:
+            return indices[0], top_scores[0]
+        return indices, top_scores
+    winners = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    winner_scores = scores[rows, winners]
+    kth_scores = winner_scores.min(axis=1)[:, np.newaxis]
+    ties = scores == kth_scores
+    tied_rows = np.nonzero(ties.sum(axis=1) > (winner_scores == kth_scores).sum(axis=1))[0]
+    if len(tied_rows):
+        # more classes share the k-th score than fit: keep the lowest indices
+        better = scores[tied_rows] > kth_scores[tied_rows]
+        num_needed = k - better.sum(axis=1)
+        tied = ties[tied_rows]
+        selected = better | (tied & (np.cumsum(tied, axis=1) <= num_needed[:, np.newaxis]))
+        winners[tied_rows] = np.nonzero(selected)[1].reshape(-1, k)
+        winner_scores = scores[rows, winners]
+    order = np.lexsort((winners, -winner_scores))
+    indices = winners[rows, order]
+    top_scores = winner_scores[rows, order]
+    if is_vector:
+        return indices[0], top_scores[0]
+    return indices, top_scores
+
+
+class FeatureExtractor(object):
+    """Extract CNN features with a Caffe net that is only built when first needed
+
+      Creating an extractor is free: caffe is imported, the mean file read,
+      the net loaded and the transformer built on first use, each step being
+      timed in startup_seconds. Code that only needs the helper functions of
+      this module never pays for the model.
+
+      Parameters:
+        deploy_prototxt : path of the deploy prototxt
+        model_file : path of the caffemodel
+        imagemean_file : path of the .npy image mean
+        layer : default blob to extract
+
+    """
+
+    def __init__(self, deploy_prototxt, model_file, imagemean_file, layer='fc7-food'):
+        self.deploy_prototxt = deploy_prototxt
+        self.model_file = model_file
+        self.imagemean_file = imagemean_file
+        self.layer = layer
+        self.startup_seconds = collections.OrderedDict()
+        self._caffe = None
+        self._mean = None
+        self._net = None
+        self._transformer = None
+
+    def _timed(self, step, function, *args):
+        start = time.time()
+        result = function(*args)
+        self.startup_seconds[step] = time.time() - start
+        return result
+
+    @property
+    def caffe(self):
+        if self._caffe is None:
+            self._caffe = self._timed('import caffe', _import_caffe)
+        return self._caffe
+
+    @property
+    def mean(self):
+        if self._mean is None:
+            self._mean = self._timed('load mean', lambda: np.load(self.imagemean_file).mean(1).mean(1))
+        return self._mean
+
+    @property
+    def net(self):
+        if self._net is None:
+            caffe = self.caffe
+            net = self._timed('load net', caffe.Net, self.deploy_prototxt, self.model_file, caffe.TEST)
+            validate_layers(net, [self.layer])
+            net.blobs['data'].reshape(1, 3, 227, 227)
+            self._net = net
+        return self._net
+
+    @property
+    def transformer_settings(self):
+        return {'mean': self.mean,
+                'transpose': (2, 0, 1),
+                'channel_swap': (2, 1, 0),
+                'raw_scale': 255.0}
+
+    def _build_transformer(self, settings, data_shape):
+        transformer = self.caffe.io.Transformer({'data': data_shape})
+        transformer.set_mean('data', settings['mean'])
+        transformer.set_transpose('data', settings['transpose'])
+        transformer.set_channel_swap('data', settings['channel_swap'])
+        transformer.set_raw_scale('data', settings['raw_scale'])
+        return transformer
+
+    @property
+    def transformer(self):
+        if self._transformer is None:
+            settings = self.transformer_settings
+            data_shape = self.net.blobs['data'].data.shape
+            self._transformer = self._timed('build transformer', self._build_transformer, settings, data_shape)
+        return self._transformer
+
+    def load(self):
+        """Load the net and build the transformer now, e.g. before forking workers
+        """
+        self.transformer
+        return self
+
+    @property
+    def num_features_out(self):
+        return get_num_features(self.net, self.layer)
+
+    def startup_report(self):
+        steps = ['%s %.2f s' % (step, seconds) for step, seconds in self.startup_seconds.items()]
+        return 'Startup : ' + (', '.join(steps) if steps else 'nothing loaded yet')
+
+    def save_features_for_all_files(self,input_image_folder,label_file,output_stores,batch_size=1,num_workers=0,
+                                    input_cache_dir=None,feature_cache=None,tta=False,store_dtype=np.float32):
+        """Extract features of every labelled image into one feature store per layer
+
+          Parameters:
+            input_image_folder : folder holding the images
+            label_file : file with one "image_file label" line per image
+            output_stores : dict mapping blob names to store paths; all the
+              layers are read from the same forward pass. A single path stores
+              the default layer.
+            batch_size : number of images per forward pass
+            num_workers : number of preprocessing processes, 0 to preprocess
+              on the main thread; the transformer is built before the workers
+              fork, so they never load the net
+            input_cache_dir : optional directory of a PreprocessedImageCache,
+              shared by all model snapshots with the same preprocessing settings
+            feature_cache : optional FeatureCache; images whose layers are all
+              cached skip the forward pass
+            tta : store the features averaged over 10 crops of every image,
+              all the crops of a batch going through one forward pass
+            store_dtype : dtype of new stores, e.g. np.float16 to halve their
+              size; existing stores keep their dtype
+
+        """
+        if isinstance(output_stores, basestring):
+            output_stores = {self.layer: output_stores}
+        if tta and input_cache_dir is not None:
+            raise ValueError("The input cache holds center crops, it cannot be used with tta")
+        layers = sorted(output_stores)
+        cache_layers = [name + '-tta' for name in layers] if tta else layers
+        validate_layers(self.net, layers)
+        labels_dict=get_label_dict(label_file)
+        stores = [FeatureStore(output_stores[name], get_num_features(self.net, name), dtype=store_dtype)
+                  for name in layers]
+        list_img_files = [img_file for img_file in os.listdir(input_image_folder)
+                          if img_file in labels_dict and not all(img_file in store for store in stores)]
+        print "Files to process : " + str(len(list_img_files))
+        input_cache = None
+        try:
+            count_files= 0
+            if feature_cache is not None:
+                list_img_files = take_cached_features(list_img_files, input_image_folder, cache_layers, stores,
+                                                      feature_cache, labels_dict, batch_size)
+                print feature_cache.summary()
+            preprocess_item = lambda img_file: self.get_preprocessed_image(img_file, input_image_folder)
+            if tta:
+                preprocess_item = lambda img_file: self.get_resized_image(img_file, input_image_folder)
+            if input_cache_dir is not None:
+                input_cache = PreprocessedImageCache(input_cache_dir, self.transformer_settings,
+                                                      self.net.blobs['data'].data.shape[1:])
+                preprocess_path = lambda image_path: self.get_preprocessed_image(os.path.basename(image_path),
+                                                                              os.path.dirname(image_path))
+                preprocess_item = lambda img_file: input_cache.preprocess(os.path.join(input_image_folder, img_file),
+                                                                          preprocess_path)
+            if num_workers > 0:
+                self.load()
+                pipeline = PreprocessPipeline(preprocess_item, batch_size, num_workers)
+                batches = pipeline.batches(list_img_files)
+            else:
+                pipeline = None
+                batches = preprocess_batches(list_img_files, preprocess_item, batch_size)
+            if input_cache is not None:
+                batches = input_cache.fill(batches, lambda img_file: os.path.join(input_image_folder, img_file))
+            if tta:
+                batches = forward_tta_batches(self.net, batches, self.transformer_settings, layers)
+            else:
+                batches = forward_batches(self.net, batches, layers)
+            for batch_files, batch_features in batches:
+                num_batch_files = len(batch_files)
+                append_to_stores(stores, batch_files, [labels_dict[img_file] for img_file in batch_files], batch_features)
+                if feature_cache is not None:
+                    put_cached_features(batch_files, input_image_folder, cache_layers, batch_features, feature_cache)
+                for img_file in batch_files:
+                    print "File Processed : "+ os.path.join(input_image_folder,img_file)
+                previous_count = count_files
+                count_files += num_batch_files
+                if count_files / 100 != previous_count / 100:
+                    print "Number of Files Processed : " + str(count_files)
+                    if pipeline is not None:
+                        print "Preprocessing : " + pipeline.stats.summary()
+                    if input_cache is not None:
+                        print input_cache.summary()
+                    if feature_cache is not None:
+                        print feature_cache.summary()
+
+        except Exception as e:
+            print e.message
+        finally:
+            for store in stores:
+                store.close()
+            if input_cache is not None:
+                print input_cache.summary()
+                input_cache.close()
+            if feature_cache is not None:
+                print feature_cache.summary()
+
+    def make_cpu_net(self):
+        caffe = self.caffe
+        caffe.set_mode_cpu()
+        return caffe.Net(self.deploy_prototxt, self.model_file, caffe.TEST)
+
+    def save_features_sharded(self,input_image_folder,label_file,output_stores,num_workers,batch_size=50):
+        """Extract features with one CPU net per worker process
+
+          Rows of the output stores come out sorted by file name, whatever the
+          number of workers. See sharded_extraction.extract_sharded.
+
+          Parameters:
+            input_image_folder : folder holding the images
+            label_file : file with one "image_file label" line per image
+            output_stores : dict mapping blob names to store paths
+            num_workers : number of worker processes, each with its own net
+            batch_size : number of images per forward pass
+
+        """
+        validate_layers(self.load().net, sorted(output_stores))
+        labels_dict=get_label_dict(label_file)
+        list_img_files = [img_file for img_file in os.listdir(input_image_folder) if img_file in labels_dict]
+        preprocess_factory = lambda worker_net: lambda img_file: self.get_preprocessed_image(img_file, input_image_folder)
+        return extract_sharded(list_img_files, [labels_dict[img_file] for img_file in list_img_files], output_stores,
+                               self.make_cpu_net, preprocess_factory, num_workers, batch_size)
+
+    def get_preprocessed_image(self, image_file, image_folder):
+        complete_input_image_path = os.path.join(image_folder, image_file)
+        if os.path.isfile(complete_input_image_path) is False:
+            print "Incorrect path : " + complete_input_image_path
+            return
+        img = self.caffe.io.load_image(complete_input_image_path)
+        return self.transformer.preprocess('data', img)
+
+    def get_resized_image(self, image_file, image_folder):
+        complete_input_image_path = os.path.join(image_folder, image_file)
+        if os.path.isfile(complete_input_image_path) is False:
+            print "Incorrect path : " + complete_input_image_path
+            return
+        img = self.caffe.io.load_image(complete_input_image_path)
+        if img.shape[:2] != IMAGE_DIMS:
+            img = self.caffe.io.resize_image(img, IMAGE_DIMS)
+        return img
+
+    def get_tta_features(self, image_files, image_folder, layers=None):
+        """Return layer activations averaged over 10 crops, for a batch of images
+
+          All the crops of all the images go through a single forward pass.
+
+          Parameters:
+            image_files : list of image file names
+            image_folder : folder holding the images
+            layers : list of blob names, the default layer if None
+
+          Returns:
+            (kept_files, features) where kept_files lists the images that
+            exist and features holds one len(kept_files) x num_features array
+            per layer
+
+        """
+        layers = layers or [self.layer]
+        validate_layers(self.net, layers)
+        kept_files = []
+        images = []
+        for image_file in image_files:
+            img = self.get_resized_image(image_file, image_folder)
+            if img is not None:
+                kept_files.append(image_file)
+                images.append(img)
+        if not images:
+            return kept_files, [np.zeros((0, get_num_features(self.net, name))) for name in layers]
+        return kept_files, forward_tta(self.net, np.array(images), self.transformer_settings, layers)
+
+    def predict_tta(self, image_files, image_folder, num_arguments=5, score_layer='prob'):
+        """Return the top classes of each image from its 10-crop averaged scores
+
+          Returns:
+            (kept_files, top_classes) where top_classes[i] holds the
+            num_arguments best classes of kept_files[i], best first
+
+        """
+        kept_files, features = self.get_tta_features(image_files, image_folder, [score_layer])
+        return kept_files, list(get_top_k(features[0], num_arguments)[0])
+
+    def get_image_features(self, image_file, image_folder, feature_cache=None):
+        if feature_cache is not None and os.path.isfile(os.path.join(image_folder, image_file)):
+            features = feature_cache.get(os.path.join(image_folder, image_file), self.layer)
+            if features is not None:
+                return features
+        image = self.get_preprocessed_image(image_file, image_folder)
+        if image is None:
+            return
+        features = forward_batch(self.net, [image], self.layer)[0]
+        if feature_cache is not None:
+            feature_cache.put(os.path.join(image_folder, image_file), self.layer, features)
+        return features
+
+
+default_extractor = FeatureExtractor(deploy_prototxt, model_file, imagemean_file, layer)
+
+
+def save_features_for_all_files(*args, **kwargs):
+    return default_extractor.save_features_for_all_files(*args, **kwargs)
+
+
+def save_features_sharded(*args, **kwargs):
+    return default_extractor.save_features_sharded(*args, **kwargs)
+
+
+def get_preprocessed_image(image_file, image_folder):
+    return default_extractor.get_preprocessed_image(image_file, image_folder)
+
+
+def get_image_features(image_file, image_folder, feature_cache=None):
+    return default_extractor.get_image_features(image_file, image_folder, feature_cache)
 
 
 if __name__ == '__main__':
-    label_file = '/mnt/data/train_data.txt'
-    save_features_for_all_files("/mnt/data/train",label_file,'/mnt/data/f7_features_train.p')
-    label_file = '/mnt/data/test_data.txt'
-    save_features_for_all_files("/mnt/data/test",label_file,'/mnt/data/f7_features_test.p')
+    batch_size = 50
+    num_workers = 4
+    feature_cache = FeatureCache('/mnt/data/feature_cache', [model_file, deploy_prototxt], max_bytes=20 << 30)
+    for split in ['train', 'test']:
+        label_file = '/mnt/data/' + split + '_data.txt'
+        output_stores = {'pool5': '/mnt/data/pool5_features_' + split,
+                         'fc6-food': '/mnt/data/f6_features_' + split,
+                         'fc7-food': '/mnt/data/f7_features_' + split}
+        save_features_for_all_files('/mnt/data/' + split,label_file,output_stores,batch_size,num_workers,
+                                    feature_cache=feature_cache)
+        print default_extractor.startup_report()
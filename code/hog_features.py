@@ -5,8 +5,11 @@ from sklearn import svm
 from sklearn.cross_validation import train_test_split
 import cPickle
 from scipy import misc
+import multiprocessing
 import os
 
+from descriptor_extraction import apply_by_shape, save_descriptor_features
+
 def rgb2gray(rgb):
     """Convert RGB image to grayscale
 
@@ -74,46 +77,91 @@ def hog_feature(im):
     return orientation_histogram.ravel()
 
 
+def hog_features_batch(images, orientations=9, cell_size=(8, 8)):
+    """Compute the HOG features of hog_feature for a stack of images at once
 
+      Every pixel is assigned to its orientation bin once and the cell
+      histograms of the whole stack are accumulated with a single bincount,
+      instead of one full-image filter per orientation and image. Pixels are
+      binned exactly as in hog_feature (an orientation of exactly 0 or of
+      180 and more counts nowhere) and the features come in the same order,
+      cell columns first.
 
-def get_files_processed(output_file):
-    if os.path.isfile(output_file) is False:
-        return set([])
-    lines = open(output_file, 'r').read().splitlines()
-    files = set([line.split(',')[0] for line in lines])
-    return files
-
-
-def calculate_save_hog_features(image_dir,output_file_path):
-    list_img_files = os.listdir(image_dir)
-    processed_files = get_files_processed(output_file_path)
-    out_file = open(output_file_path, mode='a')
-    try:
-        count_files=0
-        for img_file in list_img_files:
-            if img_file in processed_files:
-                continue
-            complete_img_path = os.path.join(image_dir,img_file)
-            img = misc.imread(complete_img_path)
-            features = hog_feature(img)
-            feature_str = ",".join((features[np.newaxis,:]).astype('str')[0])
-            out_file.write(img_file + ',' + feature_str + '\n')
-            print "File Processed : " + os.path.join(image_dir, img_file)
-            count_files += 1
-            if count_files % 100 == 0:
-                print "Number of Files Processed : " + str(count_files)
-    except Exception as e:
-        print e.message
-    finally:
-        out_file.close()
+      Parameters:
+        images : N x H x W x 3 stack of rgb images or N x H x W stack of
+          grayscale images, all of the same size
+        orientations : number of gradient bins
+        cell_size : (height, width) of a cell in pixels
 
+      Returns:
+        feat : N x n_features float64 matrix, one hog_feature row per image
 
-if __name__ == '__main__':
-    calculate_save_hog_features("/mnt/data/train", '/mnt/data/hog_features_train.txt')
-    calculate_save_hog_features("/mnt/data/test", '/mnt/data/hog_features_test.txt')
+      Matches hog_feature on sizes that are not a multiple of the cell size
+      and on grayscale stacks (run with python -m doctest hog_features.py):
+
+        >>> images = np.random.RandomState(0).randint(0, 256, (3, 42, 43, 3))
+        >>> np.allclose(hog_features_batch(images), [hog_feature(image) for image in images])
+        True
+        >>> np.allclose(hog_features_batch(images[..., 0]), [hog_feature(image) for image in images[..., 0]])
+        True
+
+    """
+    images = np.asarray(images)
+    if images.ndim == 4:
+        image = rgb2gray(images)
+    else:
+        image = images.astype(np.float64)
+    num_images, sx, sy = image.shape
+    cx, cy = cell_size
+    n_cellsx = sx // cx
+    n_cellsy = sy // cy
 
+    gx = np.zeros(image.shape)
+    gy = np.zeros(image.shape)
+    gx[:, :, :-1] = np.diff(image, n=1, axis=2)
+    gy[:, :-1, :] = np.diff(image, n=1, axis=1)
+    # only the pixels of whole cells count
+    gx = gx[:, :n_cellsx * cx, :n_cellsy * cy]
+    gy = gy[:, :n_cellsx * cx, :n_cellsy * cy]
+    grad_mag = np.sqrt(gx ** 2 + gy ** 2)
+    grad_ori = np.arctan2(gy, (gx + 1e-15)) * (180 / np.pi) + 90
+
+    bin_width = 180 / orientations
+    bins = np.floor(grad_ori / bin_width).astype(np.intp)
+    # undo rounding of the division so the bin edges match the comparisons of hog_feature
+    bins -= grad_ori < bins * bin_width
+    bins += grad_ori >= (bins + 1) * bin_width
+    valid = (grad_ori > 0) & (bins >= 0) & (bins < orientations)
+
+    rows = np.arange(n_cellsx * cx) // cx
+    cols = np.arange(n_cellsy * cy) // cy
+    cell = cols[np.newaxis, :] * n_cellsx + rows[:, np.newaxis]
+    n_cells = n_cellsx * n_cellsy
+    index = (np.arange(num_images)[:, np.newaxis, np.newaxis] * n_cells + cell) * orientations + bins
+    histogram = np.bincount(index[valid], weights=grad_mag[valid], minlength=num_images * n_cells * orientations)
+    return histogram.reshape(num_images, -1) / (cx * cy)
+
+
+def hog_features_of_images(images):
+    """Run hog_features_batch on a list of images, one call per image size
+    """
+    return apply_by_shape(hog_features_batch, images)
 
 
+def calculate_save_hog_features(image_dir,output_store_path,label_file=None,batch_size=64,num_workers=0):
+    """Compute the HOG features of every image of a folder into a FeatureStore
 
+      See descriptor_extraction.save_descriptor_features for the chunked,
+      resumable writing and the parameters.
+
+    """
+    save_descriptor_features(image_dir, output_store_path, hog_features_of_images, label_file, batch_size,
+                             num_workers)
 
 
+if __name__ == '__main__':
+    num_workers = multiprocessing.cpu_count()
+    calculate_save_hog_features("/mnt/data/train", '/mnt/data/hog_features_train', '/mnt/data/train_data.txt',
+                                num_workers=num_workers)
+    calculate_save_hog_features("/mnt/data/test", '/mnt/data/hog_features_test', '/mnt/data/test_data.txt',
+                                num_workers=num_workers)
@@ -0,0 +1,254 @@
+"""
+Local HTTP inference service with dynamic micro-batching
+Concurrent requests are preprocessed on their own handler threads, then
+collected into micro-batches that go through the net in one forward pass.
+
+POST /predict  {"image": "/path/to/image.jpg", "k": 5}
+  -> {"classes": [...], "scores": [...]}
+  k defaults to the max_k of the server; a k outside 1..max_k gets a 400.
+GET /metrics
+  -> batch size, queue wait and inference latency histograms
+"""
+
+import argparse
+import BaseHTTPServer
+import bisect
+import json
+import os
+import Queue
+import SocketServer
+import threading
+import time
+
+import numpy as np
+
+from batch_features import forward_batch
+from get_features import get_top_k
+
+
+class Histogram(object):
+    """Thread safe histogram with fixed bucket upper bounds
+    """
+
+    def __init__(self, bounds):
+        self.bounds = list(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.bounds, value)] += 1
+            self.count += 1
+            self.total += value
+
+    def snapshot(self):
+        with self.lock:
+            buckets = [{'le': bound, 'count': count} for bound, count in zip(self.bounds, self.counts)]
+            buckets.append({'le': 'inf', 'count': self.counts[-1]})
+            return {'count': self.count, 'mean': self.total / max(self.count, 1), 'buckets': buckets}
+
+
+LATENCY_BOUNDS = [0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0]
+BATCH_SIZE_BOUNDS = [1, 2, 4, 8, 16, 32, 64, 128, 256]
+
+
+class _Request(object):
+
+    def __init__(self, image):
+        self.image = image
+        self.arrival = time.time()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class MicroBatcher(object):
+    """Collect concurrent requests into micro-batches run by one background thread
+
+      A batch is closed as soon as it holds max_batch_size requests or
+      max_latency seconds after its first request arrived, whichever comes
+      first.
+
+      Parameters:
+        run_batch : callable mapping an N x C x H x W array to a list of N
+          results; only ever called from the batching thread
+        max_batch_size : largest number of requests per batch
+        max_latency : longest time in seconds a request waits for others
+
+    """
+
+    def __init__(self, run_batch, max_batch_size=32, max_latency=0.005):
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.queue = Queue.Queue()
+        self.batch_size_histogram = Histogram(BATCH_SIZE_BOUNDS)
+        self.queue_wait_histogram = Histogram(LATENCY_BOUNDS)
+        self.inference_histogram = Histogram(LATENCY_BOUNDS)
+        self.thread = threading.Thread(target=self._loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, image):
+        """Queue one preprocessed image and block until its result is ready
+        """
+        request = _Request(image)
+        self.queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _collect(self):
+        batch = [self.queue.get()]
+        deadline = batch[0].arrival + self.max_latency
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.time()
+            try:
+                if timeout > 0:
+                    batch.append(self.queue.get(timeout=timeout))
+                else:
+                    # past the deadline, only take requests that are already queued
+                    batch.append(self.queue.get_nowait())
+            except Queue.Empty:
+                break
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+            start = time.time()
+            for request in batch:
+                self.queue_wait_histogram.observe(start - request.arrival)
+            self.batch_size_histogram.observe(len(batch))
+            try:
+                results = self.run_batch(np.array([request.image for request in batch]))
+                for request, result in zip(batch, results):
+                    request.result = result
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+            self.inference_histogram.observe(time.time() - start)
+            for request in batch:
+                request.done.set()
+
+    def metrics(self):
+        return {'batch_size': self.batch_size_histogram.snapshot(),
+                'queue_wait_seconds': self.queue_wait_histogram.snapshot(),
+                'inference_seconds': self.inference_histogram.snapshot()}
+
+
+def make_top_k_runner(net, score_layer='prob', max_k=5):
+    """Return a run_batch callable giving (classes, scores) of the max_k best classes per image
+    """
+    def run_batch(images):
+        classes, scores = get_top_k(forward_batch(net, images, score_layer), max_k)
+        return zip(classes.tolist(), scores.tolist())
+    return run_batch
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def _send_json(self, code, payload):
+        body = json.dumps(payload)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self._send_json(404, {'error': 'unknown path ' + self.path})
+            return
+        self._send_json(200, self.server.batcher.metrics())
+
+    def do_POST(self):
+        if self.path != '/predict':
+            self._send_json(404, {'error': 'unknown path ' + self.path})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.getheader('Content-Length', 0))))
+            k = int(request.get('k', self.server.max_k))
+            if not 1 <= k <= self.server.max_k:
+                raise ValueError('k must be between 1 and %d, got %d' % (self.server.max_k, k))
+            image = self.server.preprocess(request['image'])
+        except Exception as e:
+            self._send_json(400, {'error': str(e)})
+            return
+        if image is None:
+            self._send_json(404, {'error': 'image not found: ' + request['image']})
+            return
+        try:
+            classes, scores = self.server.batcher.submit(image)
+        except Exception as e:
+            self._send_json(500, {'error': str(e)})
+            return
+        self._send_json(200, {'classes': classes[:k], 'scores': scores[:k]})
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class InferenceServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Threaded HTTP server answering top-k queries through a MicroBatcher
+
+      Parameters:
+        address : (host, port) to listen on; port 0 picks a free port
+        net : caffe.Net or any object with the same blobs interface
+        preprocess : callable mapping an image path to a C x H x W array, or
+          None if the image does not exist; runs on the request threads
+        score_layer : blob holding the class scores
+        max_k : largest number of classes a request can ask for
+        max_batch_size, max_latency : see MicroBatcher
+
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, net, preprocess, score_layer='prob', max_k=5, max_batch_size=32,
+                 max_latency=0.005, verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, _Handler)
+        self.preprocess = preprocess
+        self.max_k = max_k
+        self.verbose = verbose
+        self.batcher = MicroBatcher(make_top_k_runner(net, score_layer, max_k), max_batch_size, max_latency)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Serve top-k food classes over HTTP')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--max-batch-size', type=int, default=32)
+    parser.add_argument('--max-latency', type=float, default=0.005,
+                        help='Seconds a request may wait for others to join its batch')
+    parser.add_argument('--standin', action='store_true',
+                        help='Serve a CPU stand-in net on synthetic images instead of the Caffe model')
+    parser.add_argument('--verbose', action='store_true')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.standin:
+        from standin_net import StandInNet, StandInTransformer, random_image
+        net = StandInNet()
+        transformer = StandInTransformer()
+        preprocess = lambda path: transformer.preprocess(
+            'data', random_image(np.random.RandomState(abs(hash(path)) % (1 << 31))))
+    else:
+        from get_features import default_extractor
+        net = default_extractor.load().net
+        preprocess = lambda path: default_extractor.get_preprocessed_image(os.path.basename(path),
+                                                                           os.path.dirname(path))
+    server = InferenceServer((args.host, args.port), net, preprocess, max_batch_size=args.max_batch_size,
+                             max_latency=args.max_latency, verbose=args.verbose)
+    print 'Serving on http://%s:%d' % server.server_address
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from feature_store import FeatureStore
+
+
+def settings_hash(settings):
+    """Return a short hex digest identifying a dict of preprocessing settings
+
+      Parameters:
+        settings : dict mapping names to numbers, tuples or numpy arrays
+
+      Returns:
+        hash : 16 character hex string; equal settings give equal hashes
+
+    """
+    digest = hashlib.sha1()
+    for name in sorted(settings):
+        value = settings[name]
+        digest.update(name.encode('utf-8'))
+        if isinstance(value, np.ndarray):
+            value = np.ascontiguousarray(value)
+            digest.update(str(value.dtype) + str(value.shape))
+            digest.update(value.tobytes())
+        else:
+            digest.update(repr(value))
+    return digest.hexdigest()[:16]
+
+
+def _jsonable(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return value
+
+
+class PreprocessedImageCache(object):
+    """
+    Persistent cache of preprocessed C x H x W input tensors.
+
+    The tensors are kept in a FeatureStore under cache_dir/<settings hash>, so
+    model snapshots that share the preprocessing settings share the cache and
+    any change to the settings starts a fresh one. Entries are keyed by image
+    path and modification time; a modified image gets a new entry.
+
+    Lookups only read the store, so they can run in the forked workers of a
+    PreprocessPipeline. New tensors are added by the process that owns the
+    cache, through fill().
+    """
+
+    def __init__(self, cache_dir, settings, input_shape, shard_size=1000):
+        """
+        Inputs:
+        - cache_dir: Root directory of the cache.
+        - settings: Dict of the preprocessing settings, e.g. mean, transpose,
+          channel swap and raw scale.
+        - input_shape: Shape (C, H, W) of one preprocessed image.
+        - shard_size: Number of images per shard of the underlying store.
+        """
+        self.input_shape = tuple(input_shape)
+        all_settings = dict(settings)
+        all_settings['input_shape'] = self.input_shape
+        self.settings_hash = settings_hash(all_settings)
+        self.path = os.path.join(cache_dir, self.settings_hash)
+        self.store = FeatureStore(self.path, int(np.prod(self.input_shape)), dtype=np.float32,
+                                  shard_size=shard_size)
+        settings_path = os.path.join(self.path, 'settings.json')
+        if not os.path.isfile(settings_path):
+            with open(settings_path, 'w') as f:
+                json.dump(dict((name, _jsonable(value)) for name, value in all_settings.items()), f)
+        self.hits = 0
+        self.misses = 0
+
+    def cache_key(self, image_path):
+        return '%s@%r' % (os.path.abspath(image_path), os.path.getmtime(image_path))
+
+    def lookup(self, image_path):
+        """
+        Return the cached tensor of an image as a view on the store, or None.
+        """
+        key = self.cache_key(image_path)
+        if key not in self.store:
+            return None
+        return self.store.get(key).reshape(self.input_shape)
+
+    def preprocess(self, image_path, preprocess_path):
+        """
+        Return the cached tensor of an image, or preprocess_path(image_path)
+        if it is not cached. Nothing is added to the cache.
+        """
+        image = None
+        if os.path.isfile(image_path):
+            image = self.lookup(image_path)
+        if image is None:
+            image = preprocess_path(image_path)
+        return image
+
+    def fill(self, batches, image_path_of_item):
+        """
+        Pass (items, images) batches through, adding the images that are not
+        cached yet and counting hits and misses.
+
+        Inputs:
+        - batches: Iterable of (items, images) tuples.
+        - image_path_of_item: Callable mapping an item to its image path.
+        """
+        for batch_items, images in batches:
+            new_keys = []
+            new_key_set = set()
+            new_rows = []
+            for item, image in zip(batch_items, images):
+                key = self.cache_key(image_path_of_item(item))
+                if key in self.store or key in new_key_set:
+                    self.hits += 1
+                    continue
+                self.misses += 1
+                new_keys.append(key)
+                new_key_set.add(key)
+                new_rows.append(np.asarray(image).reshape(-1))
+            if new_keys:
+                self.store.append(new_keys, ['-'] * len(new_keys), np.array(new_rows))
+            yield batch_items, images
+
+    def summary(self):
+        return 'input cache %s: %d entries, %d hits, %d misses' % (
+            self.settings_hash, len(self.store), self.hits, self.misses)
+
+    def close(self):
+        self.store.close()
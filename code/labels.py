@@ -0,0 +1,4 @@
+def get_label_dict(label_file):
+    lines= open(label_file).read().splitlines()
+    dict_labels={ x.split(' ')[0].strip() : x.split(' ')[1].strip() for x in lines}
+    return dict_labels
@@ -0,0 +1,150 @@
+import os
+
+import numpy as np
+
+from feature_store import FeatureStore
+
+PROJECTION_FILE = 'projection.npz'
+
+
+class PCAProjection(object):
+    """
+    PCA projection fitted from streamed chunks of rows.
+
+    partial_fit only accumulates the row count, the column sums and the
+    D x D scatter matrix, so the data can be seen one shard at a time and
+    never has to be in memory as a whole. finalize computes the mean and the
+    top components from them.
+    """
+
+    def __init__(self, num_components, whiten=False):
+        """
+        Inputs:
+        - num_components: Dimension K of the projected features.
+        - whiten: Whether to scale the projected features to unit variance.
+        """
+        self.num_components = num_components
+        self.whiten = whiten
+        self.num_rows = 0
+        self.sums = None
+        self.scatter = None
+        self.mean = None
+        self.components = None
+        self.explained_variance = None
+
+    def partial_fit(self, X):
+        """
+        Accumulate the statistics of a chunk X of shape (N, D).
+        """
+        X = np.asarray(X, dtype=np.float64)
+        if self.sums is None:
+            self.sums = np.zeros(X.shape[1])
+            self.scatter = np.zeros((X.shape[1], X.shape[1]))
+        self.num_rows += X.shape[0]
+        self.sums += X.sum(axis=0)
+        self.scatter += X.T.dot(X)
+        return self
+
+    def finalize(self):
+        """
+        Compute the mean, the (D, K) components and their variances.
+        """
+        if self.num_rows < 2:
+            raise ValueError("Need at least 2 rows to fit a projection")
+        self.mean = self.sums / self.num_rows
+        covariance = (self.scatter - self.num_rows * np.outer(self.mean, self.mean)) / (self.num_rows - 1)
+        variances, vectors = np.linalg.eigh(covariance)
+        top = np.argsort(variances)[::-1][:self.num_components]
+        self.explained_variance = np.maximum(variances[top], 0)
+        self.components = vectors[:, top]
+        # fix the sign of every component so refits give the same projection
+        signs = np.sign(self.components[np.abs(self.components).argmax(axis=0), np.arange(len(top))])
+        self.components *= np.where(signs == 0, 1, signs)
+        self.sums = None
+        self.scatter = None
+        return self
+
+    def transform(self, X):
+        """
+        Project X of shape (N, D) to shape (N, K), in float32.
+        """
+        projected = (np.asarray(X, dtype=np.float32) - self.mean.astype(np.float32)).dot(
+            self.components.astype(np.float32))
+        if self.whiten:
+            projected /= np.sqrt(self.explained_variance + 1e-8).astype(np.float32)
+        return projected
+
+    def save(self, path):
+        np.savez(path, mean=self.mean, components=self.components,
+                 explained_variance=self.explained_variance, whiten=self.whiten)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        projection = cls(data['components'].shape[1], bool(data['whiten']))
+        projection.mean = data['mean']
+        projection.components = data['components']
+        projection.explained_variance = data['explained_variance']
+        return projection
+
+
+def fit_store_projection(store, num_components, whiten=False, chunk_size=10000):
+    """
+    Fit a PCAProjection over all rows of a FeatureStore, chunk by chunk.
+    """
+    projection = PCAProjection(num_components, whiten)
+    for start in range(0, len(store), chunk_size):
+        projection.partial_fit(store.read_rows(start, start + chunk_size))
+    return projection.finalize()
+
+
+def compact_store(input_path, output_path, num_components=None, dtype=np.float16, whiten=False,
+                  projection=None, chunk_size=10000):
+    """
+    Write a compact copy of a feature store: optionally PCA projected, stored
+    as dtype (float16 by default).
+
+    Inputs:
+    - input_path: Path of the source FeatureStore.
+    - output_path: Path of the compact FeatureStore; rows already there are
+      kept, so an interrupted run can be rerun.
+    - num_components: Dimension of the PCA projection, or None to only
+      change the dtype.
+    - dtype: Dtype of the compact store.
+    - whiten: Whether the projection whitens.
+    - projection: A fitted PCAProjection to reuse, e.g. the one fitted on
+      the training store when compacting the test store. If None and
+      num_components is set, a projection is fitted on input_path.
+    - chunk_size: Number of rows read at a time.
+
+    Returns the compact FeatureStore, opened read only. The projection is
+    saved with it and comes back from load_store_projection.
+    """
+    source = FeatureStore(input_path, mode='r')
+    if projection is None and num_components is not None:
+        projection = fit_store_projection(source, num_components, whiten, chunk_size)
+    num_features = source.num_features if projection is None else projection.num_components
+    output = FeatureStore(output_path, num_features, dtype=dtype, shard_size=source.shard_size)
+    if projection is not None:
+        projection.save(os.path.join(output_path, PROJECTION_FILE))
+    try:
+        for start in range(len(output), len(source), chunk_size):
+            stop = min(start + chunk_size, len(source))
+            rows = source.read_rows(start, stop)
+            if projection is not None:
+                rows = projection.transform(rows)
+            output.append(source.keys[start:stop], source.labels[start:stop], rows)
+    finally:
+        output.close()
+        source.close()
+    return FeatureStore(output_path, mode='r')
+
+
+def load_store_projection(store_path):
+    """
+    Return the PCAProjection saved with a compact store, or None.
+    """
+    path = os.path.join(store_path, PROJECTION_FILE)
+    if not os.path.isfile(path):
+        return None
+    return PCAProjection.load(path)
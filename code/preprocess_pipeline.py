@@ -0,0 +1,98 @@
+import multiprocessing
+import time
+
+import numpy as np
+
+from batch_features import iter_batches, preprocess_batch
+from worker_pool import imap_bounded, make_pool, worker_state
+
+
+def _preprocess_batch_in_worker(batch):
+    start = time.time()
+    kept_items, images = preprocess_batch(batch, worker_state()['preprocess_item'])
+    if images:
+        images = np.ascontiguousarray(np.array(images, dtype=np.float32))
+    return kept_items, images, time.time() - start
+
+
+class PipelineStats(object):
+    """Counters collected while a PreprocessPipeline runs
+
+      queue_depths holds, for every batch handed to the consumer, how many
+      batches were already decoded and waiting. A depth that stays near zero
+      together with a large wait_seconds means decoding is the bottleneck; a
+      full queue means the forward passes are.
+
+    """
+
+    def __init__(self):
+        self.num_batches = 0
+        self.num_items = 0
+        self.wait_seconds = 0.0
+        self.worker_seconds = 0.0
+        self.queue_depths = []
+        self.start_time = time.time()
+
+    def mean_queue_depth(self):
+        if not self.queue_depths:
+            return 0.0
+        return float(np.mean(self.queue_depths))
+
+    def summary(self):
+        elapsed = time.time() - self.start_time
+        return ('batches %d, images %d, elapsed %.2f s, consumer waited %.2f s (%.1f%%), '
+                'worker busy %.2f s, mean queue depth %.2f' %
+                (self.num_batches, self.num_items, elapsed, self.wait_seconds,
+                 100.0 * self.wait_seconds / max(elapsed, 1e-12), self.worker_seconds,
+                 self.mean_queue_depth()))
+
+
+class PreprocessPipeline(object):
+    """Decode and preprocess images in worker processes ahead of the forward passes
+
+      A pool of worker processes turns batches of items into N x C x H x W
+      float32 arrays. At most max_queued_batches batches are in flight at any
+      time, so memory stays bounded when the consumer is slower than the
+      workers. Batches come out in the order of the input items.
+
+      preprocess_item reaches the workers through worker_pool.make_pool, so
+      it need not be picklable; it should not touch the GPU.
+
+      Parameters:
+        preprocess_item : callable mapping an item to a C x H x W image, or to
+          None for items that should be skipped
+        batch_size : number of items per batch
+        num_workers : number of worker processes
+        max_queued_batches : bound on batches being decoded or waiting
+
+    """
+
+    def __init__(self, preprocess_item, batch_size, num_workers=multiprocessing.cpu_count(), max_queued_batches=None):
+        self.preprocess_item = preprocess_item
+        self.batch_size = batch_size
+        self.num_workers = max(num_workers, 1)
+        self.max_queued_batches = max_queued_batches or 2 * self.num_workers
+        self.stats = PipelineStats()
+
+    def batches(self, items):
+        """Yield (kept_items, images) tuples for the items, in order
+
+          Batches whose items were all skipped are not yielded.
+
+        """
+        self.stats = PipelineStats()
+        pool = make_pool(self.num_workers, {'preprocess_item': self.preprocess_item})
+        try:
+            results = imap_bounded(pool, _preprocess_batch_in_worker, iter_batches(items, self.batch_size),
+                                   self.max_queued_batches, self.stats)
+            for kept_items, images, worker_seconds in results:
+                self.stats.worker_seconds += worker_seconds
+                if not kept_items:
+                    continue
+                self.stats.num_batches += 1
+                self.stats.num_items += len(kept_items)
+                yield kept_items, images
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
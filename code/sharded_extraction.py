@@ -0,0 +1,139 @@
+import os
+import shutil
+import time
+
+from batch_features import forward_batches, get_num_features, preprocess_batches, validate_layers
+from feature_store import FeatureStore, append_to_stores, merge_stores
+from worker_pool import make_pool, worker_state
+
+
+def split_shards(items, num_shards):
+    """Split items into num_shards contiguous, nearly equal lists
+
+      Parameters:
+        items : sequence of items in their final row order
+        num_shards : number of shards
+
+      Returns:
+        list of num_shards lists; concatenated they give back items
+
+    """
+    num_shards = max(1, min(num_shards, len(items)))
+    shard_size, remainder = divmod(len(items), num_shards)
+    shards = []
+    start = 0
+    for shard_id in range(num_shards):
+        stop = start + shard_size + (1 if shard_id < remainder else 0)
+        shards.append(list(items[start:stop]))
+        start = stop
+    return shards
+
+
+def shard_store_path(output_store, shard_id):
+    return os.path.join(output_store + '.shards', 'shard_%03d' % shard_id)
+
+
+def _missing_items(store_path, items):
+    if not os.path.isdir(store_path):
+        return list(items)
+    with FeatureStore(store_path, mode='r') as store:
+        return [item for item in items if item not in store]
+
+
+def _build_worker_net(state):
+    state['net'] = state['net_factory']()
+    state['preprocess_item'] = state['preprocess_factory'](state['net'])
+
+
+def _extract_shard(task):
+    shard_id, items, labels, output_stores, batch_size = task
+    start = time.time()
+    net = worker_state()['net']
+    layers = sorted(output_stores)
+    validate_layers(net, layers)
+    stores = [FeatureStore(shard_store_path(output_stores[name], shard_id),
+                           get_num_features(net, name)) for name in layers]
+    label_of_item = dict(zip(items, labels))
+    pending = [item for item in items if not all(item in store for store in stores)]
+    try:
+        batches = preprocess_batches(pending, worker_state()['preprocess_item'], batch_size)
+        for batch_items, batch_features in forward_batches(net, batches, layers):
+            append_to_stores(stores, batch_items, [label_of_item[item] for item in batch_items], batch_features)
+    finally:
+        for store in stores:
+            store.close()
+    return shard_id, len(pending), time.time() - start
+
+
+def extract_sharded(items, labels, output_stores, net_factory, preprocess_factory, num_workers,
+                    batch_size=50, num_shards=None, verbose=True):
+    """Extract features with one net per worker process and merge the shards
+
+      The items are sorted and split into contiguous shards. Every worker
+      process builds its own net with net_factory and its own preprocessing
+      with preprocess_factory, then writes each shard it is given to per
+      shard FeatureStores next to the outputs (<output>.shards/shard_XXX).
+      Finally the shards are merged into the output stores in sorted item
+      order, so the row order does not depend on the number of workers or on
+      which worker finished first. Shards and merges are resumable.
+
+      Once an output store holds every item, its shard stores are deleted, so
+      a finished run does not leave a second copy of every layer on disk.
+      Only the items some output is missing are sharded and extracted, so a
+      rerun after the merge only re-merges and a run with new items extracts
+      just those. The shards of an output missing some items, e.g. images
+      that failed to decode, are kept so the next run resumes from them.
+
+      Every worker builds its net once, from factories that need not be
+      picklable (see worker_pool.make_pool).
+
+      Parameters:
+        items : image items, e.g. file names
+        labels : label of every item
+        output_stores : dict mapping blob names to output store paths
+        net_factory : callable returning a new net, e.g. a caffe.Net in CPU mode
+        preprocess_factory : callable mapping a net to a preprocess_item callable
+        num_workers : number of worker processes
+        batch_size : number of images per forward pass
+        num_shards : number of shards, 4 per worker by default so fast workers
+          pick up more of them
+        verbose : print a line per finished shard
+
+      Returns:
+        dict mapping blob names to the merged stores, opened read only
+
+    """
+    label_of_item = dict(zip(items, labels))
+    items = sorted(items)
+    missing = dict((name, _missing_items(path, items)) for name, path in output_stores.items())
+    pending_stores = dict((name, output_stores[name]) for name in missing if missing[name])
+    todo = sorted(set(item for name in pending_stores for item in missing[name]))
+    num_shards = num_shards or 4 * num_workers
+    shards = split_shards(todo, num_shards)
+    label_shards = [[label_of_item[item] for item in shard] for shard in shards]
+    if pending_stores:
+        tasks = [(shard_id, shard, label_shards[shard_id], pending_stores, batch_size)
+                 for shard_id, shard in enumerate(shards)]
+        pool = make_pool(num_workers, {'net_factory': net_factory, 'preprocess_factory': preprocess_factory},
+                         _build_worker_net)
+        try:
+            for shard_id, count, seconds in pool.imap_unordered(_extract_shard, tasks):
+                if verbose:
+                    print "Shard %d : %d images in %.1f s" % (shard_id, count, seconds)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    merged = {}
+    for name in sorted(output_stores):
+        if name in pending_stores:
+            # every shard on disk, including those of an earlier run split differently
+            shards_dir = output_stores[name] + '.shards'
+            shard_paths = [os.path.join(shards_dir, shard) for shard in sorted(os.listdir(shards_dir))]
+            merged[name] = merge_stores(shard_paths, output_stores[name], key_order=items)
+            if all(item in merged[name] for item in items):
+                shutil.rmtree(shards_dir)
+        else:
+            merged[name] = FeatureStore(output_stores[name], mode='r')
+    return merged
+
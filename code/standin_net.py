@@ -0,0 +1,99 @@
+import time
+
+import numpy as np
+
+DEFAULT_LAYERS = (('pool5', (256, 6, 6)), ('fc6-food', (4096,)), ('fc7-food', (4096,)), ('prob', (101,)))
+
+
+class StandInBlob(object):
+    """Minimal replacement for a caffe blob: a data array that can be reshaped"""
+
+    def __init__(self, shape, dtype=np.float32):
+        self.data = np.zeros(shape, dtype=dtype)
+
+    def reshape(self, *shape):
+        if tuple(shape) != self.data.shape:
+            self.data = np.zeros(shape, dtype=self.data.dtype)
+
+
+class StandInNet(object):
+    """CPU stand-in for caffe.Net used to benchmark the extraction code
+
+      Every output layer is a fixed random projection of a fixed random sample
+      of the input pixels followed by a ReLU, so the cost of a forward pass
+      grows with the batch size like a real net does, and equal inputs always
+      give equal outputs.
+
+      Parameters:
+        input_shape : C x H x W shape of one input image
+        layers : sequence of (blob name, per image shape) pairs
+        num_samples : number of input pixels each projection reads
+        forward_overhead : seconds slept on every forward call, to mimic the
+          fixed per-call cost of launching a real net
+        seed : seed of the random projections
+
+    """
+
+    def __init__(self, input_shape=(3, 227, 227), layers=DEFAULT_LAYERS, num_samples=256,
+                 forward_overhead=0.0, seed=0):
+        rng = np.random.RandomState(seed)
+        self.forward_overhead = forward_overhead
+        self.blobs = {'data': StandInBlob((1,) + tuple(input_shape))}
+        self.layer_shapes = []
+        self.weights = {}
+        input_dim = int(np.prod(input_shape))
+        self.sample_indices = np.sort(rng.choice(input_dim, min(num_samples, input_dim), replace=False))
+        for name, shape in layers:
+            shape = tuple(shape)
+            self.layer_shapes.append((name, shape))
+            self.blobs[name] = StandInBlob((1,) + shape)
+            self.weights[name] = (rng.randn(len(self.sample_indices), int(np.prod(shape))) /
+                                  np.sqrt(len(self.sample_indices))).astype(np.float32)
+
+    def forward(self):
+        if self.forward_overhead:
+            time.sleep(self.forward_overhead)
+        data = self.blobs['data'].data
+        num_images = data.shape[0]
+        sample = data.reshape(num_images, -1)[:, self.sample_indices]
+        outputs = {}
+        for name, shape in self.layer_shapes:
+            blob = self.blobs[name]
+            blob.reshape(num_images, *shape)
+            out = blob.data.reshape(num_images, -1)
+            np.dot(sample, self.weights[name], out=out)
+            np.maximum(out, 0, out=out)
+            outputs[name] = blob.data
+        return outputs
+
+
+class StandInTransformer(object):
+    """Stand-in for caffe.io.Transformer with the settings used in get_features
+
+      The input image is center cropped or edge padded to the net input size
+      instead of resized, which is enough for benchmarking.
+
+    """
+
+    def __init__(self, input_shape=(3, 227, 227), mean=None, raw_scale=255.0, channel_swap=(2, 1, 0)):
+        self.input_shape = tuple(input_shape)
+        self.mean = np.zeros(input_shape[0], dtype=np.float32) if mean is None else np.asarray(mean)
+        self.raw_scale = raw_scale
+        self.channel_swap = channel_swap
+
+    def preprocess(self, in_, data):
+        channels, height, width = self.input_shape
+        top = max((data.shape[0] - height) // 2, 0)
+        left = max((data.shape[1] - width) // 2, 0)
+        crop = data[top:top + height, left:left + width]
+        if crop.shape[:2] != (height, width):
+            crop = np.pad(crop, ((0, height - crop.shape[0]), (0, width - crop.shape[1]), (0, 0)), mode='edge')
+        image = crop.transpose(2, 0, 1)[list(self.channel_swap)].astype(np.float32)
+        image *= self.raw_scale
+        image -= self.mean[:, np.newaxis, np.newaxis]
+        return image
+
+
+def random_image(rng, shape=(256, 256, 3)):
+    """Return a random float image in [0, 1] shaped like caffe.io.load_image output"""
+    return rng.rand(*shape).astype(np.float32)
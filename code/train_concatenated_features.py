@@ -4,9 +4,40 @@ import sys
 import os
 sys.path.append(os.path.join(os.getcwd(),"../utils"))
 from neural_net import *
+from feature_store import FeatureStore
+from pca_projection import load_store_projection
 
 
-def train_and_plot(X_train,y_train,X_test,y_test,num_iters=1000,learning_rate=1e-4,reg=0.5):
+def train_and_plot(X_train,y_train,X_test,y_test,num_iters=1000,learning_rate=1e-4,reg=0.5,sampling=None,
+                   block_size=256,buffer_blocks=64):
+    """Train a TwoLayerNet on the features and plot its loss and accuracies
+
+      X_train and X_test may be in-memory arrays, memmaps or sharded
+      FeatureStores (see load_store_features). Data that is not in memory is
+      trained on with block sampling, which reads it in contiguous blocks,
+      and is classified chunk by chunk. Stores list their rows by file
+      name, i.e. grouped by class, and a block sampled batch only mixes the
+      rows of buffer_blocks blocks; see minibatch_loader.MinibatchLoader.
+
+      Parameters:
+        X_train, y_train : training features and integer labels
+        X_test, y_test : validation features and integer labels
+        num_iters, learning_rate, reg : see TwoLayerNet.train
+        sampling : sampling of TwoLayerNet.train; by default 'epoch' for
+          in-memory arrays and 'block' otherwise, unlike TwoLayerNet.train
+          itself, which keeps the 'replacement' sampling of earlier
+          versions; pass 'replacement' to reproduce earlier runs
+        block_size, buffer_blocks : rows per contiguous read and blocks
+          shuffled together by block sampling; the window of
+          block_size * buffer_blocks rows is held in memory
+
+      Returns:
+        net : the trained TwoLayerNet
+
+    """
+    if sampling is None:
+        in_memory = isinstance(X_train, np.ndarray) and not isinstance(X_train, np.memmap)
+        sampling = 'epoch' if in_memory else 'block'
     input_size=X_train.shape[1]
     hidden_size=input_size
     num_classes=101
@@ -14,7 +45,8 @@ def train_and_plot(X_train,y_train,X_test,y_test,num_iters=1000,learning_rate=1e
     stats = net.train(X_train, y_train, X_test, y_test,
             num_iters=num_iters, batch_size=256,
             learning_rate=learning_rate, learning_rate_decay=0.95,
-            reg=reg, verbose=True)
+            reg=reg, verbose=True, sampling=sampling,
+            block_size=block_size, buffer_blocks=buffer_blocks)
     # Plot the loss function and train / validation accuracies
     plt.subplot(2, 1, 1)
     plt.plot(stats['loss_history'])
@@ -29,6 +61,47 @@ def train_and_plot(X_train,y_train,X_test,y_test,num_iters=1000,learning_rate=1e
     plt.xlabel('Epoch')
     plt.ylabel('Clasification accuracy')
     plt.show()
+    return net
+
+
+def load_store_features(store_path, mmap=False):
+    """Load the features and integer labels of a feature store for TwoLayerNet
+
+      Compact stores written by pca_projection.compact_store stay in their
+      stored dtype (float16 by default); TwoLayerNet upcasts each batch when
+      it multiplies by its weights, so the matrix in memory stays compact.
+
+      Parameters:
+        store_path : path of the FeatureStore
+        mmap : leave the rows on disk instead of loading them: a single
+          shard store, such as the output of concatenate_stores, gives a
+          memmap and a store with several shards gives the FeatureStore
+          itself, opened read only; both can be passed to train_and_plot
+
+      Returns:
+        X : N x D feature matrix, memmap or FeatureStore
+        y : N labels
+        projection : PCAProjection saved with the store, or None
+
+    """
+    store = FeatureStore(store_path, mode='r')
+    y = store.label_array()
+    if mmap and store.num_shards() > 1:
+        return store, y, load_store_projection(store_path)
+    with store:
+        X = store.read_rows(0, len(store))
+        if not mmap:
+            X = np.array(X)
+    return X, y, load_store_projection(store_path)
+
+
+def predict_raw_features(net, X_raw, projection=None):
+    """Predict labels for raw features, e.g. fresh fc7 activations, of a net
+    trained on a compact store, applying the projection saved with that store
+    """
+    if projection is not None:
+        X_raw = projection.transform(X_raw)
+    return net.predict(X_raw)
 
 
 
@@ -0,0 +1,102 @@
+import numpy as np
+
+from batch_features import forward_batch_layers
+
+# prepared_data.py resizes every image to 256 x 256 with resize_cover
+IMAGE_DIMS = (256, 256)
+CROP_DIMS = (227, 227)
+NUM_CROPS = 10
+
+
+def oversample(images, crop_dims=CROP_DIMS):
+    """Take the 4 corner crops, the center crop and their mirrors of every image
+
+      Vectorized equivalent of caffe.io.oversample.
+
+      Parameters:
+        images : N x H x W x K array of images of the same size
+        crop_dims : (height, width) of the crops
+
+      Returns:
+        crops : (10 N) x h x w x K array; the 10 crops of image i are rows
+          10 i to 10 i + 9, the 5 unmirrored ones first
+
+    """
+    images = np.asarray(images)
+    num_images, height, width = images.shape[:3]
+    crop_height, crop_width = crop_dims
+    tops = [0, 0, height - crop_height, height - crop_height, (height - crop_height) // 2]
+    lefts = [0, width - crop_width, 0, width - crop_width, (width - crop_width) // 2]
+    crops = np.empty((num_images, NUM_CROPS, crop_height, crop_width) + images.shape[3:], dtype=images.dtype)
+    for i, (top, left) in enumerate(zip(tops, lefts)):
+        crops[:, i] = images[:, top:top + crop_height, left:left + crop_width]
+    crops[:, 5:] = crops[:, :5, :, ::-1]
+    return crops.reshape((num_images * NUM_CROPS,) + crops.shape[2:])
+
+
+def preprocess_crops(crops, settings):
+    """Apply the Transformer settings used in get_features to a stack of crops at once
+
+      Same steps, in the same order, as caffe.io.Transformer.preprocess for
+      an image that is already at the input size: transpose, channel swap,
+      raw scale and mean subtraction.
+
+      Parameters:
+        crops : M x h x w x K float array with values in [0, 1]
+        settings : dict with 'transpose', 'channel_swap', 'raw_scale' and
+          'mean' (one value per channel)
+
+      Returns:
+        M x K x h x w float32 array ready for the data blob
+
+    """
+    transpose = (0,) + tuple(axis + 1 for axis in settings['transpose'])
+    data = crops.astype(np.float32).transpose(transpose)
+    data = data[:, list(settings['channel_swap'])]
+    data *= settings['raw_scale']
+    data -= np.asarray(settings['mean'], dtype=np.float32).reshape(1, -1, 1, 1)
+    return data
+
+
+def average_crops(features, num_crops=NUM_CROPS):
+    """Average each consecutive group of num_crops rows
+
+      Parameters:
+        features : (num_crops N) x D array
+
+      Returns:
+        N x D array
+
+    """
+    return features.reshape(-1, num_crops, features.shape[1]).mean(axis=1)
+
+
+def forward_tta(net, images, settings, layers, crop_dims=CROP_DIMS):
+    """Run all crops of a batch of images through a single forward pass
+
+      Parameters:
+        net : caffe.Net or any object with the same blobs interface
+        images : N x H x W x K array of images with values in [0, 1]
+        settings : Transformer settings, see preprocess_crops
+        layers : list of blob names
+        crop_dims : (height, width) of the crops; the input size of the net
+
+      Returns:
+        list with one N x num_features array per layer, averaged over the
+        crops of each image
+
+    """
+    data = preprocess_crops(oversample(images, crop_dims), settings)
+    return [average_crops(features) for features in forward_batch_layers(net, data, layers)]
+
+
+def forward_tta_batches(net, batches, settings, layers, crop_dims=CROP_DIMS):
+    """Run forward_tta for every (items, images) batch
+
+      Returns:
+        generator of (items, features) tuples where features is the list
+        returned by forward_tta
+
+    """
+    for batch_items, images in batches:
+        yield batch_items, forward_tta(net, np.asarray(images), settings, layers, crop_dims)
@@ -0,0 +1,80 @@
+import collections
+import multiprocessing
+import time
+
+_worker_state = {}
+
+
+def set_worker_state(state, setup=None):
+    """Replace the state read by worker_state in this process
+
+      Parameters:
+        state : dict of values the tasks need, e.g. nets or preprocessing
+          callables
+        setup : optional callable run once on the state dict after it is set,
+          e.g. to build a net from a factory in it
+
+    """
+    _worker_state.clear()
+    _worker_state.update(state)
+    if setup is not None:
+        setup(_worker_state)
+
+
+def worker_state():
+    """Return the state dict of the current process, see make_pool
+    """
+    return _worker_state
+
+
+def make_pool(num_workers, state, setup=None):
+    """Start a process pool whose workers hold state
+
+      The state is handed to the workers when the pool forks, so nets and
+      callables in it do not need to be picklable. Tasks read it with
+      worker_state(); without a pool, set_worker_state gives the current
+      process the same state.
+
+      Parameters:
+        num_workers : number of worker processes
+        state, setup : see set_worker_state
+
+    """
+    return multiprocessing.Pool(num_workers, set_worker_state, (state, setup))
+
+
+def imap_bounded(pool, function, tasks, max_queued, stats=None):
+    """Like pool.imap, but with at most max_queued tasks submitted and not yet consumed
+
+      Results come out in the order of the tasks. Bounding the tasks in
+      flight bounds the memory held by finished results when the consumer is
+      slower than the workers.
+
+      Parameters:
+        pool : multiprocessing.Pool
+        function : picklable function applied to every task
+        tasks : iterable of tasks
+        max_queued : bound on tasks being processed or waiting
+        stats : optional object with a queue_depths list and a wait_seconds
+          counter, e.g. a PipelineStats; before every result the number of
+          finished results waiting is appended to queue_depths and the time
+          spent waiting for the result is added to wait_seconds
+
+    """
+    pending = collections.deque()
+    tasks = iter(tasks)
+    for task in tasks:
+        pending.append(pool.apply_async(function, (task,)))
+        if len(pending) >= max_queued:
+            break
+    while pending:
+        if stats is not None:
+            stats.queue_depths.append(sum(1 for result in pending if result.ready()))
+        start = time.time()
+        result = pending.popleft().get()
+        if stats is not None:
+            stats.wait_seconds += time.time() - start
+        for task in tasks:
+            pending.append(pool.apply_async(function, (task,)))
+            break
+        yield result
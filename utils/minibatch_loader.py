@@ -0,0 +1,239 @@
+import Queue
+import threading
+
+import numpy as np
+
+
+def read_row_block(X, start, stop):
+  """
+  Return the rows [start, stop) of X as an array.
+
+  X may be a numpy array, a memmap, or a sharded source with a
+  read_rows(start, stop) method such as a FeatureStore; the rows are read
+  with one contiguous slice per shard.
+  """
+  if hasattr(X, 'read_rows'):
+    return X.read_rows(start, stop)
+  return X[start:stop]
+
+
+def iter_row_blocks(X, block_size):
+  """
+  Yield (start, rows) for consecutive blocks of block_size rows of X, read
+  front to back with read_row_block.
+  """
+  for start in xrange(0, X.shape[0], block_size):
+    yield start, read_row_block(X, start, start + block_size)
+
+
+def gather_rows(X, indices, block_size=1024):
+  """
+  Return the rows of X at the sorted indices as an in-memory array, reading
+  only the blocks of block_size rows that hold some of them, front to back.
+  """
+  out = np.empty((len(indices),) + X.shape[1:], dtype=X.dtype)
+  bounds = np.searchsorted(indices, np.arange(0, X.shape[0] + block_size, block_size))
+  for i, start in enumerate(xrange(0, X.shape[0], block_size)):
+    first, last = bounds[i], bounds[i + 1]
+    if first < last:
+      block = read_row_block(X, start, start + block_size)
+      out[first:last] = block[indices[first:last] - start]
+  return out
+
+
+class MinibatchLoader(object):
+  """
+  Endless source of (X_batch, y_batch) minibatches gathered into reused
+  buffers, optionally by a background thread while the caller computes.
+
+  Three sampling modes are supported:
+  - 'epoch': the rows are shuffled once per epoch and taken in that order
+    without replacement. Epochs follow each other seamlessly, so every
+    batch holds batch_size rows and every row is seen once per epoch. The
+    rows of a batch are gathered in increasing order, so a memory-mapped X
+    is read front to back.
+  - 'replacement': every batch draws batch_size rows with replacement with
+    np.random.choice from the global np.random state, on the calling
+    thread, exactly as TwoLayerNet.train always did, so runs seeded the same
+    way give the same batches as before. prefetch is ignored: drawing ahead
+    on another thread would change the global random stream.
+  - 'block': for data that does not fit in memory. The rows are split into
+    blocks of block_size consecutive rows, and the blocks of the whole file
+    are shuffled once per epoch. buffer_blocks blocks at a time, taken in
+    that order and so drawn from anywhere in the file, are read with
+    contiguous reads into an in-memory window, whose rows are shuffled and
+    handed out without replacement. Every row is still seen once per epoch,
+    but X is only ever read in large sequential pieces, never row by row.
+    X may also be a sharded source with a read_rows(start, stop) method and
+    shape and dtype attributes, such as a FeatureStore.
+
+    The price is a less thorough shuffle: a batch only mixes the rows of
+    buffer_blocks blocks. The feature stores are written in file name
+    order, which groups Food-101 images by class, so a block holds one or
+    two classes and a batch at most about 2 * buffer_blocks of them. More,
+    smaller blocks mix better; fewer, larger ones read faster. Keep
+    buffer_blocks well above the number of classes per batch you want.
+
+  'epoch' and 'block' draw from a private random state, seeded once from the
+  global np.random state when the loader is created. np.random.seed
+  therefore makes them reproducible, with or without prefetching, and
+  however far the background thread runs ahead, it never changes what the
+  caller's own np.random calls return.
+
+  A batch returned by next() stays valid until the following call to next();
+  its buffer is then handed back to be filled again.
+  """
+
+  def __init__(self, X, y, batch_size, sampling='epoch', prefetch=1, block_size=256,
+               buffer_blocks=64):
+    """
+    Inputs:
+    - X: Array of shape (N, D); a numpy array or a memmap.
+    - y: Array of shape (N,) of labels.
+    - batch_size: Number of rows per batch.
+    - sampling: 'epoch', 'replacement' or 'block', see above.
+    - prefetch: Number of batches gathered ahead by a background thread; 0
+      gathers every batch on the calling thread when it is asked for.
+    - block_size: With 'block' sampling, number of consecutive rows read at
+      once.
+    - buffer_blocks: With 'block' sampling, number of blocks, from anywhere
+      in the file, shuffled together; the window holds
+      block_size * buffer_blocks rows in memory.
+    """
+    if sampling not in ('epoch', 'replacement', 'block'):
+      raise ValueError('Invalid sampling: ' + str(sampling))
+    if sampling != 'block' and not isinstance(X, np.ndarray):
+      raise ValueError("Row sources without random access need sampling='block'")
+    self.X = X
+    self.y = y
+    self.batch_size = batch_size
+    self.sampling = sampling
+    if sampling == 'replacement':
+      prefetch = 0
+    else:
+      self._random = np.random.RandomState(np.random.randint(2 ** 31 - 1))
+    self.prefetch = prefetch
+    self.num_train = X.shape[0]
+    self.epoch = 0
+    self._order = np.zeros(0, dtype=np.intp)
+    self._position = 0
+    if sampling == 'block':
+      self.block_size = block_size
+      self._block_order = np.zeros(0, dtype=np.intp)
+      self._block_position = 0
+      window_rows = min(block_size * buffer_blocks, self.num_train)
+      self._window = np.empty((window_rows,) + X.shape[1:], dtype=X.dtype)
+      self._window_y = np.empty(window_rows, dtype=y.dtype)
+      self._buffer_blocks = buffer_blocks
+    num_buffers = prefetch + 1
+    self._free = Queue.Queue()
+    for _ in range(num_buffers):
+      self._free.put((np.empty((batch_size,) + X.shape[1:], dtype=X.dtype),
+                      np.empty(batch_size, dtype=y.dtype)))
+    self._ready = Queue.Queue()
+    self._current = None
+    self._stopped = False
+    self._thread = None
+    if prefetch > 0:
+      self._thread = threading.Thread(target=self._fill_loop)
+      self._thread.daemon = True
+      self._thread.start()
+
+  def _next_indices(self):
+    if self.sampling == 'replacement':
+      return np.random.choice(np.arange(self.num_train), self.batch_size)
+    parts = []
+    needed = self.batch_size
+    while needed > 0:
+      if self._position == len(self._order):
+        self._order = self._random.permutation(self.num_train)
+        self._position = 0
+        self.epoch += 1
+      part = self._order[self._position:self._position + needed]
+      self._position += len(part)
+      needed -= len(part)
+      parts.append(part)
+    return np.sort(np.concatenate(parts))
+
+  def _fill_window(self):
+    # the next buffer_blocks blocks of the epoch, read in file order
+    if self._block_position == len(self._block_order):
+      num_blocks = (self.num_train + self.block_size - 1) // self.block_size
+      self._block_order = self._random.permutation(num_blocks)
+      self._block_position = 0
+      self.epoch += 1
+    blocks = self._block_order[self._block_position:self._block_position + self._buffer_blocks]
+    self._block_position += len(blocks)
+    num_rows = 0
+    for block in np.sort(blocks):
+      start = block * self.block_size
+      stop = min(start + self.block_size, self.num_train)
+      self._window[num_rows:num_rows + stop - start] = read_row_block(self.X, start, stop)
+      self._window_y[num_rows:num_rows + stop - start] = self.y[start:stop]
+      num_rows += stop - start
+    self._order = self._random.permutation(num_rows)
+    self._position = 0
+
+  def _fill_from_windows(self, X_batch, y_batch):
+    filled = 0
+    while filled < self.batch_size:
+      if self._position == len(self._order):
+        self._fill_window()
+      part = self._order[self._position:self._position + self.batch_size - filled]
+      self._position += len(part)
+      np.take(self._window, part, axis=0, out=X_batch[filled:filled + len(part)], mode='clip')
+      np.take(self._window_y, part, out=y_batch[filled:filled + len(part)], mode='clip')
+      filled += len(part)
+
+  def _fill(self, buffers):
+    X_batch, y_batch = buffers
+    if self.sampling == 'block':
+      self._fill_from_windows(X_batch, y_batch)
+      return buffers
+    indices = self._next_indices()
+    # the indices are always valid; with the default mode='raise', take
+    # gathers into a temporary batch and copies it into out
+    np.take(self.X, indices, axis=0, out=X_batch, mode='clip')
+    np.take(self.y, indices, out=y_batch, mode='clip')
+    return buffers
+
+  def _fill_loop(self):
+    try:
+      while True:
+        buffers = self._free.get()
+        if self._stopped:
+          return
+        self._ready.put(self._fill(buffers))
+    except Exception as e:
+      self._ready.put(e)
+
+  def next(self):
+    """
+    Return the next (X_batch, y_batch).
+    """
+    if self._current is not None:
+      self._free.put(self._current)
+      self._current = None
+    if self._thread is None:
+      self._current = self._fill(self._free.get())
+    else:
+      batch = self._ready.get()
+      if isinstance(batch, Exception):
+        raise batch
+      self._current = batch
+    return self._current
+
+  def __iter__(self):
+    while True:
+      yield self.next()
+
+  def close(self):
+    """
+    Stop the background thread.
+    """
+    self._stopped = True
+    if self._thread is not None:
+      # wake the thread up if it waits for a free buffer
+      self._free.put(None)
+      self._thread.join()
+      self._thread = None
@@ -1,6 +1,132 @@
+import Queue
+import resource
+import threading
+import time
+
 import numpy as np
 import matplotlib.pyplot as plt
 
+from minibatch_loader import MinibatchLoader, gather_rows, iter_row_blocks
+
+
+def softmax_loss(scores, y, out=None):
+  """
+  Fused softmax cross-entropy loss and its gradient.
+
+  The loss of every row is its log-sum-exp minus its correct class score,
+  both taken after subtracting the row max, so large scores cannot
+  overflow. The correct class scores are gathered by index, and the
+  probabilities are turned into the gradient in place.
+
+  Inputs:
+  - scores: Array of shape (N, C) of class scores; it is not modified.
+  - y: Array of shape (N,) of labels, 0 <= y[i] < C.
+  - out: Optional array of shape (N, C) that receives the gradient; it may be
+    scores itself.
+
+  Returns a tuple of:
+  - loss: Mean softmax loss over the N rows.
+  - dscores: Gradient of the loss with respect to scores, of shape (N, C);
+    out if it was given.
+  """
+  N = scores.shape[0]
+  rows = np.arange(N)
+  row_max = np.max(scores, axis=1, keepdims=True)
+  correct_scores = scores[rows, y] - row_max[:, 0]
+  dscores = np.subtract(scores, row_max, out=out)
+  np.exp(dscores, out=dscores)
+  sums = np.sum(dscores, axis=1, keepdims=True)
+  loss = np.sum(np.log(sums[:, 0]) - correct_scores) / N
+  dscores /= sums
+  dscores[rows, y] -= 1
+  dscores /= N
+  return loss, dscores
+
+
+class TrainingWorkspace(object):
+  """
+  Activation and gradient buffers of a TwoLayerNet training step.
+
+  Buffers are allocated the first time they are asked for and reused for
+  as long as their shape and dtype stay the same, so a run with a fixed
+  batch size allocates them once. buffer_misses counts the requests that
+  had to allocate a buffer; it says nothing about arrays allocated outside
+  the workspace.
+  """
+
+  def __init__(self):
+    self.buffers = {}
+    self.buffer_misses = 0
+
+  def get(self, name, shape, dtype=np.float64):
+    """
+    Return the buffer called name, allocating it if it does not have the
+    given shape and dtype yet. Its content is undefined.
+    """
+    buf = self.buffers.get(name)
+    if buf is None or buf.shape != shape or buf.dtype != dtype:
+      buf = self.buffers[name] = np.empty(shape, dtype=dtype)
+      self.buffer_misses += 1
+    return buf
+
+
+class ValidationWorker(object):
+  """
+  Background thread computing validation accuracies while training goes on.
+
+  Each submitted snapshot of the weights is evaluated in turn, so the
+  accuracies come back in submission order. The matrix products release the
+  GIL, so on a multi-core machine the evaluation overlaps the training
+  steps.
+  """
+
+  def __init__(self, evaluate):
+    """
+    Inputs:
+    - evaluate: Callable mapping (params, *args) to an accuracy.
+    """
+    self.evaluate = evaluate
+    self._tasks = Queue.Queue()
+    self._results = []
+    self._error = None
+    self._thread = threading.Thread(target=self._run)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def _run(self):
+    while True:
+      task = self._tasks.get()
+      if task is None:
+        return
+      if self._error is not None:
+        continue
+      try:
+        self._results.append(self.evaluate(*task))
+      except Exception as e:
+        self._error = e
+
+  def submit(self, params, *args):
+    """
+    Queue the evaluation of a copy of params, passing args along.
+    """
+    snapshot = dict((name, value.copy()) for name, value in params.items())
+    self._tasks.put((snapshot,) + args)
+
+  def results(self):
+    """
+    Wait for the queued evaluations and return their accuracies.
+    """
+    self.close()
+    if self._error is not None:
+      raise self._error
+    return self._results
+
+  def close(self):
+    if self._thread is not None:
+      self._tasks.put(None)
+      self._thread.join()
+      self._thread = None
+
 
 class TwoLayerNet(object):
   """
@@ -95,14 +221,7 @@ class TwoLayerNet(object):
     # classifier loss. So that your results match ours, multiply the            #
     # regularization loss by 0.5                                                #
     #############################################################################
-    C = len(b2)
-    y_boolean_matrix = np.zeros((N, C))
-    for i in np.arange(N):
-      y_boolean_matrix[i, y[i]] = 1
-    normalized_scores_matrix = scores - np.max(scores)
-    exp_scores_matrix = np.exp(normalized_scores_matrix)
-    p_matrix = exp_scores_matrix / np.sum(exp_scores_matrix, axis=-1)[:, np.newaxis]
-    data_loss = (-1.0 * np.sum(np.log(np.sum(y_boolean_matrix * p_matrix, axis=-1))))/N
+    data_loss, dscores = softmax_loss(scores, y)
     reg_loss = 0.5 * reg * (np.sum(W1 * W1) + np.sum(W2 * W2))
     loss = data_loss + reg_loss
     pass
@@ -117,14 +236,13 @@ class TwoLayerNet(object):
     # and biases. Store the results in the grads dictionary. For example,       #
     # grads['W1'] should store the gradient on W1, and be a matrix of same size #
     #############################################################################
-    dLdScore = p_matrix-y_boolean_matrix # (N,C)
-    grads['b2'] = (np.ones((1,N)).dot(dLdScore)/N)[0] #(1,C)
-    grads['W2'] = (h.T).dot(dLdScore)/N + reg*W2   # H,C
-    dLdh = dLdScore.dot(W2.T) # N,H
-    dhdh_score = h_score > 0
-    dLdh_score = dLdh * dhdh_score #N,H
-    grads['b1']= (np.ones((1,N)).dot(dLdh_score)/N)[0]# 1,H
-    grads['W1'] = (X.T).dot(dLdh_score)/N + reg*W1 # D,H
+    # dscores already holds dLoss/dScores, averaged over the batch
+    grads['b2'] = np.sum(dscores, axis=0) # C
+    grads['W2'] = (h.T).dot(dscores) + reg*W2   # H,C
+    dLdh_score = dscores.dot(W2.T) # N,H
+    dLdh_score[h_score <= 0] = 0
+    grads['b1'] = np.sum(dLdh_score, axis=0) # H
+    grads['W1'] = (X.T).dot(dLdh_score) + reg*W1 # D,H
     pass
     #############################################################################
     #                              END OF YOUR CODE                             #
@@ -132,18 +250,87 @@ class TwoLayerNet(object):
 
     return loss, grads
 
+  def sgd_step(self, X_batch, y_batch, learning_rate, reg, workspace):
+    """
+    Take one SGD step on a minibatch without allocating any activation or
+    gradient array: the forward and backward passes run and the parameters
+    are updated in place, all through the buffers of workspace.
+
+    Inputs:
+    - X_batch: Array of shape (B, D) of training data.
+    - y_batch: Array of shape (B,) of training labels.
+    - learning_rate: Scalar giving learning rate for optimization.
+    - reg: Regularization strength.
+    - workspace: TrainingWorkspace holding the buffers.
+
+    Returns:
+    - loss: Loss of the batch, as returned by loss.
+    """
+    W1, b1 = self.params['W1'], self.params['b1']
+    W2, b2 = self.params['W2'], self.params['b2']
+    B, D = X_batch.shape
+    H, C = W1.shape[1], W2.shape[1]
+
+    X_input = X_batch
+    if X_batch.dtype != W1.dtype:
+      # cast once instead of letting every dot product make a converted copy
+      X_input = workspace.get('X_input', (B, D), W1.dtype)
+      np.copyto(X_input, X_batch)
+
+    # forward pass
+    h = workspace.get('h', (B, H), W1.dtype)
+    np.dot(X_input, W1, out=h)
+    h += b1
+    np.maximum(h, 0, out=h)
+    scores = workspace.get('scores', (B, C), W1.dtype)
+    np.dot(h, W2, out=scores)
+    scores += b2
+    data_loss, dscores = softmax_loss(scores, y_batch, out=scores)
+    loss = data_loss + 0.5 * reg * (np.vdot(W1, W1) + np.vdot(W2, W2))
+
+    # backward pass
+    grad_b2 = workspace.get('grad_b2', (C,), W2.dtype)
+    np.sum(dscores, axis=0, out=grad_b2)
+    grad_W2 = workspace.get('grad_W2', (H, C), W2.dtype)
+    np.dot(h.T, dscores, out=grad_W2)
+    dh = workspace.get('dh', (B, H), W1.dtype)
+    np.dot(dscores, W2.T, out=dh)
+    active = workspace.get('active', (B, H), np.bool_)
+    np.greater(h, 0, out=active)
+    dh *= active
+    grad_b1 = workspace.get('grad_b1', (H,), W1.dtype)
+    np.sum(dh, axis=0, out=grad_b1)
+    grad_W1 = workspace.get('grad_W1', (D, H), W1.dtype)
+    np.dot(X_input.T, dh, out=grad_W1)
+
+    # W -= learning_rate * (grad_W + reg * W), in place
+    for W, grad_W in ((W1, grad_W1), (W2, grad_W2)):
+      W *= 1 - learning_rate * reg
+      grad_W *= learning_rate
+      W -= grad_W
+    for b, grad_b in ((b1, grad_b1), (b2, grad_b2)):
+      grad_b *= learning_rate
+      b -= grad_b
+    return loss
+
   def train(self, X, y, X_val, y_val,
             learning_rate=1e-3, learning_rate_decay=0.95,
             reg=1e-5, num_iters=100,
-            batch_size=200, verbose=False):
+            batch_size=200, verbose=False, preallocate=False,
+            sampling='replacement', prefetch=0, block_size=256, buffer_blocks=64,
+            val_max_bytes=64 << 20,
+            val_subsample=None, val_background=False):
     """
     Train this neural network using stochastic gradient descent.
 
     Inputs:
-    - X: A numpy array of shape (N, D) giving training data.
+    - X: A numpy array of shape (N, D) giving training data. With
+      sampling='block' it may also be a memmap or a sharded source such as
+      a FeatureStore, which is then only read in contiguous blocks.
     - y: A numpy array f shape (N,) giving training labels; y[i] = c means that
       X[i] has label c, where 0 <= c < C.
-    - X_val: A numpy array of shape (N_val, D) giving validation data.
+    - X_val: A numpy array of shape (N_val, D) giving validation data; it
+      may be memory-mapped or sharded as well, see predict.
     - y_val: A numpy array of shape (N_val,) giving validation labels.
     - learning_rate: Scalar giving learning rate for optimization.
     - learning_rate_decay: Scalar giving factor used to decay the learning rate
@@ -152,6 +339,44 @@ class TwoLayerNet(object):
     - num_iters: Number of steps to take when optimizing.
     - batch_size: Number of training examples to use per step.
     - verbose: boolean; if true print progress during optimization.
+    - preallocate: boolean; if true take the steps with sgd_step, which
+      reuses preallocated buffers instead of allocating new arrays.
+    - sampling: 'replacement' (the default) to draw every batch with
+      replacement from the global np.random state exactly as earlier
+      versions did, so seeded runs reproduce; 'epoch' to shuffle the
+      training data once per epoch and sample without replacement; or
+      'block' to shuffle blocks of consecutive rows for data that stays on
+      disk; see MinibatchLoader.
+      Block sampling mixes fewer classes per batch when the rows are
+      grouped by class, as in the feature stores.
+    - prefetch: Number of batches gathered ahead by a background thread, 0
+      (the default) to gather them between steps. Ignored with
+      sampling='replacement'.
+    - block_size, buffer_blocks: With sampling='block', rows per contiguous
+      read and blocks shuffled together; see MinibatchLoader.
+    - val_max_bytes: Cap on the temporary memory of a validation pass; the
+      validation data is classified in chunks small enough to fit in it.
+    - val_subsample: Optional number of validation rows. If given, a fixed
+      random subset of that size, the same for every run, is used for the
+      intermediate epochs and only the last accuracy check covers the full
+      validation set.
+    - val_background: boolean; if true the validation accuracies are
+      computed on a snapshot of the weights by a background thread while
+      training goes on, and collected at the end.
+
+    Returns a dictionary of:
+    - loss_history, train_acc_history, val_acc_history: Loss of every step,
+      and training batch and validation accuracy of every epoch. With
+      val_subsample, all validation accuracies but the last are measured on
+      the subset and are not comparable to the last one, which covers the
+      full validation set.
+    - step_time_history: Wall time in seconds of every step.
+    - step_page_fault_history: Minor page faults of every step, i.e. fresh
+      memory pages the process touched; large temporary arrays show up here,
+      whatever allocates them, so this compares the two modes.
+    - workspace_buffer_miss_history: With preallocate, the number of
+      workspace buffers every step had to allocate; nonzero for the first
+      step only when the batch size is fixed. Empty without preallocate.
     """
     num_train = X.shape[0]
     iterations_per_epoch = max(num_train / batch_size, 1)
@@ -160,71 +385,122 @@ class TwoLayerNet(object):
     loss_history = []
     train_acc_history = []
     val_acc_history = []
-
-    for it in xrange(num_iters):
-      X_batch = None
-      y_batch = None
-
-      #########################################################################
-      # TODO: Create a random minibatch of training data and labels, storing  #
-      # them in X_batch and y_batch respectively.                             #
-      #########################################################################
-      random_indices = np.random.choice(np.arange(num_train), batch_size)
-      X_batch = X[random_indices]
-      y_batch = y[random_indices]
-      pass
-      #########################################################################
-      #                             END OF YOUR CODE                          #
-      #########################################################################
-
-      # Compute loss and gradients using the current minibatch
-      loss, grads = self.loss(X_batch, y=y_batch, reg=reg)
-      loss_history.append(loss)
-
-      #########################################################################
-      # TODO: Use the gradients in the grads dictionary to update the         #
-      # parameters of the network (stored in the dictionary self.params)      #
-      # using stochastic gradient descent. You'll need to use the gradients   #
-      # stored in the grads dictionary defined above.                         #
-      #########################################################################
-      self.params['W1'] -= grads['W1'] * learning_rate
-      self.params['b1'] -= grads['b1'] * learning_rate
-      self.params['W2'] -= grads['W2'] * learning_rate
-      self.params['b2'] -= grads['b2'] * learning_rate
-      pass
-      #########################################################################
-      #                             END OF YOUR CODE                          #
-      #########################################################################
-
-      if verbose and it % 100 == 0:
-        print 'iteration %d / %d: loss %f' % (it, num_iters, loss)
-
-      # Every epoch, check train and val accuracy and decay learning rate.
-      if it % iterations_per_epoch == 0:
-        # Check accuracy
-        train_acc = (self.predict(X_batch) == y_batch).mean()
-        val_acc = (self.predict(X_val) == y_val).mean()
-        train_acc_history.append(train_acc)
-        val_acc_history.append(val_acc)
-
-        # Decay learning rate
-        learning_rate *= learning_rate_decay
+    step_time_history = []
+    step_page_fault_history = []
+    workspace_buffer_miss_history = []
+    workspace = TrainingWorkspace() if preallocate else None
+    last_check = (num_iters - 1) // iterations_per_epoch * iterations_per_epoch
+    X_val_check, y_val_check = X_val, y_val
+    if val_subsample is not None and val_subsample < X_val.shape[0]:
+      # own random state, so the subset does not change the training batches
+      subset = np.sort(np.random.RandomState(0).choice(X_val.shape[0], val_subsample, replace=False))
+      X_val_check, y_val_check = gather_rows(X_val, subset), y_val[subset]
+    val_chunk_size = self.predict_chunk_size(val_max_bytes)
+    val_worker = ValidationWorker(self._val_accuracy) if val_background else None
+    loader = MinibatchLoader(X, y, batch_size, sampling, prefetch, block_size, buffer_blocks)
+
+    try:
+      for it in xrange(num_iters):
+        step_start = time.time()
+        page_faults = resource.getrusage(resource.RUSAGE_SELF).ru_minflt
+        #########################################################################
+        # TODO: Create a random minibatch of training data and labels, storing  #
+        # them in X_batch and y_batch respectively.                             #
+        #########################################################################
+        X_batch, y_batch = loader.next()
+        pass
+        #########################################################################
+        #                             END OF YOUR CODE                          #
+        #########################################################################
+
+        if workspace is not None:
+          buffer_misses = workspace.buffer_misses
+          loss = self.sgd_step(X_batch, y_batch, learning_rate, reg, workspace)
+          workspace_buffer_miss_history.append(workspace.buffer_misses - buffer_misses)
+        else:
+          # Compute loss and gradients using the current minibatch
+          loss, grads = self.loss(X_batch, y=y_batch, reg=reg)
+          #########################################################################
+          # TODO: Use the gradients in the grads dictionary to update the         #
+          # parameters of the network (stored in the dictionary self.params)      #
+          # using stochastic gradient descent. You'll need to use the gradients   #
+          # stored in the grads dictionary defined above.                         #
+          #########################################################################
+          self.params['W1'] -= grads['W1'] * learning_rate
+          self.params['b1'] -= grads['b1'] * learning_rate
+          self.params['W2'] -= grads['W2'] * learning_rate
+          self.params['b2'] -= grads['b2'] * learning_rate
+          pass
+          #########################################################################
+          #                             END OF YOUR CODE                          #
+          #########################################################################
+        loss_history.append(loss)
+        step_time_history.append(time.time() - step_start)
+        step_page_fault_history.append(resource.getrusage(resource.RUSAGE_SELF).ru_minflt - page_faults)
+
+        if verbose and it % 100 == 0:
+          print 'iteration %d / %d: loss %f' % (it, num_iters, loss)
+
+        # Every epoch, check train and val accuracy and decay learning rate.
+        if it % iterations_per_epoch == 0:
+          # Check accuracy
+          train_acc = (self.predict(X_batch) == y_batch).mean()
+          train_acc_history.append(train_acc)
+          if it == last_check:
+            X_val_check, y_val_check = X_val, y_val
+          if val_worker is not None:
+            val_worker.submit(self.params, X_val_check, y_val_check, val_chunk_size)
+          else:
+            val_acc_history.append(self._val_accuracy(self.params, X_val_check, y_val_check, val_chunk_size))
+
+          # Decay learning rate
+          learning_rate *= learning_rate_decay
+      if val_worker is not None:
+        val_acc_history = val_worker.results()
+    finally:
+      loader.close()
+      if val_worker is not None:
+        val_worker.close()
 
     return {
       'loss_history': loss_history,
       'train_acc_history': train_acc_history,
       'val_acc_history': val_acc_history,
+      'step_time_history': step_time_history,
+      'step_page_fault_history': step_page_fault_history,
+      'workspace_buffer_miss_history': workspace_buffer_miss_history,
     }
 
-  def predict(self, X):
+  def _val_accuracy(self, params, X, y, chunk_size):
+    return (self.predict(X, chunk_size, params) == y).mean()
+
+  def predict_chunk_size(self, max_bytes):
+    """
+    Return the number of rows predict can classify at a time while keeping
+    its temporary arrays under max_bytes.
+    """
+    W1, W2 = self.params['W1'], self.params['W2']
+    D, H = W1.shape
+    row_bytes = (D + H + W2.shape[1]) * W1.dtype.itemsize
+    return max(1, int(max_bytes // row_bytes))
+
+  def predict(self, X, chunk_size=1024, params=None):
     """
     Use the trained weights of this two-layer network to predict labels for
     data points. For each data point we predict scores for each of the C
     classes, and assign each data point to the class with the highest score.
 
+    X is read and classified chunk_size rows at a time, front to back, so a
+    memory-mapped or sharded X is streamed from disk and the hidden
+    activations never take more than chunk_size rows; see
+    predict_chunk_size to derive it from a memory budget.
+
     Inputs:
     - X: A numpy array of shape (N, D) giving N D-dimensional data points to
-      classify.
+      classify, or a memmap or sharded source such as a FeatureStore.
+    - chunk_size: Number of rows classified at a time.
+    - params: Optional dictionary of weights to use instead of self.params,
+      e.g. a snapshot taken during training.
 
     Returns:
     - y_pred: A numpy array of shape (N,) giving predicted labels for each of
@@ -236,10 +512,20 @@ class TwoLayerNet(object):
     ###########################################################################
     # TODO: Implement this function; it should be VERY simple!                #
     ###########################################################################
-    h_score = X.dot(self.params['W1']) + self.params['b1']  # N,H
-    h = np.maximum(0, h_score)  # N,H
-    scores = h.dot(self.params['W2']) + self.params['b2']  # N,C
-    y_pred = np.argmax(scores,axis=-1)
+    if params is None:
+      params = self.params
+    W1, b1 = params['W1'], params['b1']
+    W2, b2 = params['W2'], params['b2']
+    y_pred = np.empty(X.shape[0], dtype=np.intp)
+    for start, X_chunk in iter_row_blocks(X, chunk_size):
+      if X_chunk.dtype != W1.dtype:
+        X_chunk = X_chunk.astype(W1.dtype)
+      h = X_chunk.dot(W1)  # n,H
+      h += b1
+      np.maximum(h, 0, out=h)
+      scores = h.dot(W2)  # n,C
+      scores += b2
+      y_pred[start:start + len(scores)] = np.argmax(scores,axis=-1)
     pass
     ###########################################################################
     #                              END OF YOUR CODE                           #